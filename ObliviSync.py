@@ -1,21 +1,27 @@
 #!/usr/bin/env python3
 from __future__ import print_function, absolute_import, division
 
-import hashlib
-import getpass
 import binascii
 import logging
+import threading
+import functools
+import json
 
 from collections import defaultdict
-from errno import ENOENT, ENODATA, EROFS, EACCES, EIO, EBUSY
+from errno import ENOENT, ENODATA, EROFS, EACCES, EPERM, EIO, EBUSY, EEXIST, ENOTDIR, ENOTEMPTY
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 from sys import argv, exit
 from time import time
 
 from os import O_WRONLY, O_RDWR, O_APPEND
 
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
-from backend import Backend
+from fuse import FUSE, FuseOSError, Operations
+from backend import Backend, getkey
+from superblock import calc_sizes
+from instrument import InstrumentMixIn
+from filebuf import FileBuffer, trim
+from directory import Directories, is_dir, ROOT
+from readahead import Readahead
 
 import pickle
 
@@ -24,6 +30,7 @@ import pickle
 
 
 import wooram,rooram
+from policy import POLICIES, make_policy
 
 WoOram = wooram.WoOram
 load_wooram = wooram.load_wooram
@@ -35,11 +42,37 @@ load_rooram = rooram.load_rooram
 
 import sys
 
+def synchronized(method):
+    #runs an operation holding self.lock, which guards the directory cache,
+    #the table of open files and handle numbers (but not file contents,
+    #which each have their own lock)
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+#read-only attribute of every file on a read-write mount, a JSON object
+#estimating when its changes will be visible to other clients (see WoOram.eta)
+ETA_XATTR = "user.oblivisync.eta"
+
 DEBUG=False
 DEBUG_FILE=sys.stderr
 wooram.DEBUG=False
 drip_rate=3
 drip_time=3
+spill_dir=None
+wal_dir=None
+trace_rate=0
+record_file=None
+open_mem=2**28
+open_min=2**24
+dir_interval=1
+readahead=8
+dedup=False
+policy="fifo"
+repack=False
+slots=2
 
 USAGE = """{} [OPTIONS] <backend> <mountpoint> 
 <backend>   \t : where backend files are stored
@@ -50,17 +83,30 @@ OPTIONS
     -r      \t: Read-Only mount   (dflt: rw mount)
     -k      \t: set the drip rate (dflt: 3)
     -t      \t: set the drip time (dflt: 3)
+    -s dir  \t: spill cold buffered writes, encrypted, to dir (dflt: keep in memory)
+    -w dir  \t: keep a write-ahead log in dir, for fast unmount (dflt: none)
+    -m num  \t: memory budget in bytes for open file contents (dflt: 268435456)
+    -M num  \t: open files holding less than this are never spilled (dflt: 16777216)
+    -i num  \t: write directory changes back at most every num seconds (dflt: 1)
+    -a num  \t: read-only: fetch up to num fragments ahead of sequential reads (dflt: 8)
+    -D      \t: store identical full fragments only once (dflt: off)
+    -P name \t: order in which buffered writes are synced: {} (dflt: fifo)
+    -G      \t: repack small fragments across all blocks of each sync round (dflt: off)
+    -S num  \t: fragments per backend block, for a new backend (dflt: 2)
 
     -v      \t: verbose output
+    -p frac \t: trace this fraction of operations to the verbose output (dflt: 0)
+    -R file \t: record every operation (but no file contents) to file, for replay.py
     -d file \t: set verbose output to file (dflt: stderr) (use - for stdout)
-""".format(sys.argv[0])
+""".format(sys.argv[0], ", ".join(POLICIES))
 
 import getopt
 
 def parse_args():
-    global DEBUG,DEBUG_FILE, drip_rate, drip_time
+    global DEBUG,DEBUG_FILE, drip_rate, drip_time, spill_dir, wal_dir, trace_rate, record_file
+    global open_mem, open_min, dir_interval, readahead, dedup, policy, repack, slots
 
-    opt,args = getopt.getopt(sys.argv[1:], "hvd:rk:t:")
+    opt,args = getopt.getopt(sys.argv[1:], "hvd:rk:t:s:w:m:M:i:a:DP:GS:p:R:")
 
     readwrite=True
     for o,v in opt:
@@ -81,42 +127,102 @@ def parse_args():
             drip_rate=int(v)
         if o == "-t":
             drip_time= int(v)
+        if o == "-s":
+            spill_dir = v
+        if o == "-w":
+            wal_dir = v
+        if o == "-m":
+            open_mem = int(v, 0)
+        if o == "-M":
+            open_min = int(v, 0)
+        if o == "-i":
+            dir_interval = float(v)
+        if o == "-a":
+            readahead = int(v)
+        if o == "-D":
+            dedup = True
+        if o == "-P":
+            if v not in POLICIES:
+                print("unknown flush policy: {}".format(v), file=sys.stderr)
+                exit(1)
+            policy = v
+        if o == "-G":
+            repack = True
+        if o == "-S":
+            slots = int(v)
+        if o == "-p":
+            trace_rate = float(v)
+        if o == "-R":
+            record_file = v
 
     if len(args) < 2:
         print(USAGE)
         exit(1)
+    try:
+        calc_sizes(2**22, 48, slots) # as a new volume gets, see ObliviSyncRW
+    except ValueError as e:
+        print("ERROR:", e, file=sys.stderr)
+        print(USAGE)
+        exit(1)
     
     key = getkey(args[0])
         
     return args[0],args[1],key,readwrite
 
-class ObliviSyncRW(LoggingMixIn, Operations):
-    'Example memory filesystem. Supports only one level of files.'
+class ObliviSyncRW(InstrumentMixIn, Operations):
+    'Example memory filesystem. Each directory is stored in its own vnode.'
 
     def __init__(self, backdir='dbox', key=b'0123456789abcdef',
-                 drip_time=3,drip_rate=3,blocksize=2**22,total_blocks=2**10):
+                 drip_time=3,drip_rate=3,blocksize=2**22,total_blocks=2**10,
+                 spill_dir=None,wal_dir=None,backend=None,
+                 open_mem=2**28,open_min=2**24,dir_interval=1,dedup=False,policy="fifo",repack=False,slots=2):
+        super().__init__(trace_rate=trace_rate, trace_file=DEBUG_FILE,
+                         record_file=record_file)
+
+        #open files holding more than open_min bytes are spilled, biggest
+        #first, once all together hold more than open_mem
+        self.open_mem = open_mem
+        self.open_min = open_min
+
+        #directory changes are written back at most every dir_interval
+        #seconds, and before every sync round
+        self.dir_interval = dir_interval
+        self.dir_written = 0 # when directories were last written back
+
+        #FUSE calls operations from many threads, and the sync thread
+        #writes back directories; see synchronized
+        self.lock = threading.RLock()
+
+        #backend may be given directly, e.g. an in-memory one for testing
+        if backend is None:
+            backend = Backend(key, backdir)
         
         #load wooram get directory table and the wooram
-        self.woo = load_wooram(Backend(key, backdir),
-                               drip_time=3,drip_rate=3,
-                               blocksize=blocksize,total_blocks=total_blocks)
+        self.woo = load_wooram(backend,
+                               drip_time=drip_time,drip_rate=drip_rate,
+                               blocksize=blocksize,total_blocks=total_blocks,
+                               spill_dir=spill_dir,wal_dir=wal_dir,dedup=dedup,
+                               policy=make_policy(policy),repack=repack,slots=slots)
+        self.woo.before_sync = self.__flush_direntry
         self.woo.start() # start the syncer`
         
         #store blocksize
         self.bs = self.woo.fbsize
         
 
-        self.direntry = self.__read_direntry()
-        self.data = {} # (content, counter, dirty)
+        #only the root directory is loaded now, the rest when first used
+        self.dirs = Directories(self.woo)
+        self.woo.policy.is_meta = self.dirs.cache.__contains__
+        self.data = {} # (contents as a FileBuffer, counter, vnode)
         self.fd = 0
         
-        if self.direntry == None: # first mount
+        if self.dirs.load(ROOT) == None: # first mount
             if DEBUG: print("init: creating dir entry", file=DEBUG_FILE)
             now = time()
             header = dict(st_mode=(S_IFDIR | 0o755), st_ctime=now,
-                              st_mtime=now, st_atime=now, st_nlink=2, attrs={"vnode":1})
+                              st_mtime=now, st_atime=now, st_nlink=2, attrs={"vnode":ROOT})
 
-            self.direntry = {"/":header}
+            self.dirs.create(ROOT, {".":header})
             
             #write the new directory entry
             self.__write_direntry()
@@ -124,67 +230,122 @@ class ObliviSyncRW(LoggingMixIn, Operations):
 
     def __del__(self):
         #called on filesystem destrcution/unmount?
-        self.__write_direntry()
+        self.__flush_direntry()
         self.woo.finish() #wait for finish to sync
         if DEBUG: print("finished",file=DEBUG_FILE)
         del self
 
 
     def __get_vnode(self,path):
-        if path in self.direntry:
-            return self.direntry[path]['attrs']['vnode']
+        header = self.dirs.lookup(path)
+        if header is not None:
+            return header['attrs']['vnode']
         return None
 
-    
-    def __read_file(self,vnode):
-        #what if woo.get() returns None?
-        return b''.join(self.woo.get(vnode,i) for i in range(self.woo.num_blocks(vnode)))
-
-    def __write_file(self,vnode,data,dirty):
-
-        #update the mtime if any blocks are dirty
-        if any(map(bool,dirty)):
-            self.woo.set_mtime(vnode,time())
+    def __locate(self,path,exists=True):
+        #returns (directory vnode, its entries, name) for path, checking
+        #that the entry does (or with exists=False, doesn't) exist
+        loc = self.dirs.locate(path)
+        if loc is None:
+            raise FuseOSError(ENOENT)
+        if exists and loc[2] not in loc[1]:
+            raise FuseOSError(ENOENT)
+        if not exists and loc[2] in loc[1]:
+            raise FuseOSError(EEXIST)
+        return loc
+
+    def __change(self,path,fn):
+        #applies fn to the header of path and marks its directory changed
+        dvnode, entries, name = self.__locate(path)
+        fn(entries[name])
+        self.dirs.mark(dvnode)
+        self.__write_direntry()
 
-        for i in range(0, self.__blocks(len(data))):
-            #write back anything that is dirty
-            if dirty[i] == 1:
-                self.woo.set(vnode,i,data[i*self.bs:(i+1)*self.bs])
-                if DEBUG: print("__write_back: vnode: {} : block: {} len: {} DIRTY".format(vnode,i,len(data[i*self.bs: (i+1)*self.bs])),file=DEBUG_FILE)
-            else:
-                if DEBUG: print("__write_back: vnode: {} : block: {} len: {} CLEAN".format(vnode,i,len(data[i*self.bs: (i+1)*self.bs])),file=DEBUG_FILE)
+    def __add_link(self,path,delta):
+        #adjusts the link count of the directory holding path
+        parent = self.dirs.split(path)[0]
+        self.__change(parent, lambda h: h.__setitem__('st_nlink', h.get('st_nlink',2) + delta))
 
+    def __read_fragments(self,vnode,boffs):
+        return self.woo.get_many([(vnode,i) for i in boffs])
 
-    def __read_direntry(self):
-        data = self.__read_file(1)
-        if len(data) == 0: return None
-        direntry = pickle.loads(data)
-        return direntry
+    def __write_back(self,vnode,contents,before=None):
+        #write back only the fragments that changed; with before, only
+        #the (complete) ones ahead of it, which are also dropped from memory
+        dirty = contents.take_dirty(before)
+        if dirty:
+            self.woo.set_mtime(vnode,time())
+        for i in dirty:
+            self.woo.set(vnode,i,contents.fragment(i))
+            if before is not None:
+                contents.evict(i)
+            if DEBUG: print("__write_back: vnode: {} : block: {} DIRTY".format(vnode,i),file=DEBUG_FILE)
+
+    def __trim(self):
+        #over the memory budget, dirty fragments of the biggest open files
+        #go to the wooram buffer (which spills, encrypted, with -s) and
+        #are reloaded from there when needed
+        with self.lock:
+            files = {odict["vnode"]: odict["contents"] for odict in self.data.values()}
+        trim(files, self.open_mem, self.open_min,
+             lambda vnode: self.__write_back(vnode,files[vnode]))
+
+    def __new_fd(self):
+        with self.lock:
+            self.fd += 1
+            return self.fd
+
+    def __open_file(self,path):
+        #the table entry of an open file; its contents are then used
+        #holding only their own lock
+        with self.lock:
+            return self.data[path]
 
     def __write_direntry(self):
-        data = pickle.dumps(self.direntry)
-        self.__write_file(1, data,tuple(1 for _ in range(self.__blocks(len(data)))))
+        #only note the change (with dirs.mark); it is written back once
+        #dir_interval has passed since the last time, or at the next sync round
+        if time() - self.dir_written >= self.dir_interval:
+            self.__flush_direntry()
+
+    def __flush_direntry(self):
+        #called from the sync thread too, before it takes the wooram locks
+        with self.lock:
+            if not self.dirs.changed:
+                return
+            self.dir_written = time()
+            if DEBUG: print("__flush_direntry: vnodes: {}".format(sorted(self.dirs.changed)),file=DEBUG_FILE)
+            self.dirs.flush()
+
+    def destroy(self, path):
+        self.__flush_direntry()
         
     def __blocks(self, size):
         if size == 0: return 0
         return size//self.bs + (1 if size%self.bs else 0)
 
+    @synchronized
     def chmod(self, path, mode):
-        self.direntry[path]['st_mode'] &= 0o770000
-        self.direntry[path]['st_mode'] |= mode
+        def setmode(header):
+            header['st_mode'] &= 0o770000
+            header['st_mode'] |= mode
+        self.__change(path, setmode)
         self.woo.set_mtime(self.__get_vnode(path),time())
-        self.__write_direntry()#write changes
         return 0
 
 
+    @synchronized
     def chown(self, path, uid, gid):
         #not really implemented ...
-        self.direntry[path]['st_uid'] = uid
-        self.direntry[path]['st_gid'] = gid
+        def setowner(header):
+            header['st_uid'] = uid
+            header['st_gid'] = gid
+        self.__change(path, setowner)
 
     
+    @synchronized
     def create(self, path, mode):
                 
+        dvnode, entries, name = self.__locate(path, exists=False)
         now = time()
         vnode = self.woo.new()
         header = dict(st_mode=(S_IFREG | mode), st_nlink=1,
@@ -192,25 +353,25 @@ class ObliviSyncRW(LoggingMixIn, Operations):
                       st_atime=now, attrs={"vnode":vnode})
         self.woo.set_mtime(vnode,now)
 
-        self.direntry[path]=header
+        entries[name]=header
+        self.dirs.mark(dvnode)
         
         self.__write_direntry()#write now the changes occur in backend/woo
     
-        self.data[path] = dict(contents=bytes(), counter=1, dirty=[1])
+        self.data[path] = dict(contents=FileBuffer(self.bs, 0, lambda boffs: self.__read_fragments(vnode,boffs)),
+                               counter=1, vnode=vnode)
         
 
-        if DEBUG: print("creat: {} : dirty: {} header: {}".format(path,
-                                                      self.data[path]["dirty"],
-                                                        self.direntry[path]),file=DEBUG_FILE)
+        if DEBUG: print("creat: {} : header: {}".format(path, header),file=DEBUG_FILE)
 
-        self.fd += 1
-        return self.fd
+        return self.__new_fd()
 
     def __get_header(self,path):
         
 
-        if path in self.direntry:
-            vnode = self.__get_vnode(path)
+        header = self.dirs.lookup(path)
+        if header is not None:
+            vnode = header['attrs']['vnode']
             if path in self.data:
                 size = len(self.data[path]["contents"])
                 mtime = time()
@@ -218,11 +379,28 @@ class ObliviSyncRW(LoggingMixIn, Operations):
                 size = self.woo.get_size(vnode)
                 mtime = self.woo.get_mtime(vnode)
         
-            return dict(tuple(self.direntry[path].items())+(('st_size',size),(('st_mtime',mtime))))
+            return dict(tuple(header.items())+(('st_size',size),(('st_mtime',mtime))))
 
 
         return None
 
+    def flush(self, path, fh):
+        if DEBUG: print("flush: path={} : fh: {}".format(path,fh),file=DEBUG_FILE)
+        #hand everything written so far to the wooram
+        with self.lock:
+            odict = self.data.get(path)
+        if odict is not None:
+            with odict["contents"].lock:
+                self.__write_back(odict["vnode"],odict["contents"])
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        if DEBUG: print("fsync: path={} : fh: {}".format(path,fh),file=DEBUG_FILE)
+        self.flush(path, fh)
+        self.woo.fsync()
+        return 0
+
+    @synchronized
     def getattr(self, path, fh=None):
         if DEBUG: print("getattr: path={}".format(path),file=DEBUG_FILE)
         header = self.__get_header(path)
@@ -231,45 +409,60 @@ class ObliviSyncRW(LoggingMixIn, Operations):
         if DEBUG: print("       : header={}".format(header),file=DEBUG_FILE)
         return header
 
+    @synchronized
     def getxattr(self, path, name, position=0):
         if DEBUG: print("getxattr: path={} name={}".format(path,name),file=DEBUG_FILE)
         header = self.__get_header(path)
         attrs = header.get('attrs',{})
+        if name == ETA_XATTR and not is_dir(header):
+            info = self.woo.eta(attrs['vnode'])
+            #changes to an open file that haven't reached the buffer yet
+            odict = self.data.get(path)
+            info['unflushed_frags'] = len(odict['contents'].dirty) if odict else 0
+            return json.dumps(info, sort_keys=True).encode()
         try:
             return attrs[name]
         except KeyError:
             raise FuseOSError(ENODATA)
 
+    @synchronized
     def listxattr(self, path):
         if DEBUG: print("listxattr: path={}".format(path),file=DEBUG_FILE)
         header = self.__get_header(path)
         attrs = header.get('attrs',{})
         return [k for k in attrs.keys() if k != 'vnode'] #vnode could be removed by another application!
 
-    # def mkdir(self, path, mode):
-    #     self.files[path] = dict(st_mode=(S_IFDIR | mode), st_nlink=2,
-    #                             st_size=0, st_ctime=time(), st_mtime=time(),
-    #                             st_atime=time())
-
-    #     self.files['/']['st_nlink'] += 1
+    @synchronized
+    def mkdir(self, path, mode):
+        if DEBUG: print("mkdir: path={} mode={}".format(path,mode),file=DEBUG_FILE)
+        dvnode, entries, name = self.__locate(path, exists=False)
+        now = time()
+        vnode = self.woo.new()
+        entries[name] = dict(st_mode=(S_IFDIR | mode), st_nlink=2,
+                             st_ctime=now, st_atime=now, attrs={"vnode":vnode})
+        self.dirs.create(vnode, {})
+        self.dirs.mark(dvnode)
+        self.__add_link(path, 1)
+        return 0
 
+    @synchronized
     def open(self, path, flags):
         if DEBUG: print("open: path={} flags={}".format(path,flags),file=DEBUG_FILE)
-        self.fd += 1
 
         #read directory entry
         vnode = self.__get_vnode(path)
         odict = self.data.setdefault(path,{})
         
-        #set counter and load blocks if need be
+        #set counter and load blocks if need be; a file whose last release
+        #is still writing back keeps its contents
         odict.setdefault("counter",0)
-        if odict["counter"] == 0:
+        if "contents" not in odict:
+            odict['vnode'] = vnode
 
             
-            data = self.__read_file(vnode)
-            dirty = [0 for _ in range(self.__blocks(len(data)))]
-            odict['contents']=data
-            odict['dirty'] = dirty
+            #fragments are only fetched when first read or written
+            odict['contents'] = FileBuffer(self.bs, self.woo.get_size(vnode),
+                                           lambda boffs: self.__read_fragments(vnode,boffs))
 
             # This is from the ro side, but may not be needed here
             # #still syncing, something off?
@@ -278,70 +471,124 @@ class ObliviSyncRW(LoggingMixIn, Operations):
             
         odict["counter"]+=1 #increment counter
 
-        if DEBUG: print(" open: {} : dirty: {} header: {}".format(path,self.data[path]["dirty"],
-                                                        self.direntry[path]),file=DEBUG_FILE)
+        if DEBUG: print(" open: {} : vnode: {}".format(path,vnode),file=DEBUG_FILE)
                   
         #set dirty flag based on flags
 
-        return self.fd
+        return self.__new_fd()
 
     def read(self, path, size, offset, fh):
         if DEBUG: print("read: path={} size={} offset={}  fh={}".format(path,size,offset,fh),file=DEBUG_FILE)
-        return self.data[path]["contents"][offset:offset + size]
+        contents = self.__open_file(path)["contents"]
+        with contents.lock:
+            res = contents.read(offset, size)
+        self.__trim()
+        return res
 
+    @synchronized
     def readdir(self, path, fh):
         if DEBUG: print("readdir: path={}".format(path),file=DEBUG_FILE)
-        #self.__write_direnty()#write direnty for any updates?
-        #self.direntry = self.__read_direntry() # reload in case of remote updates?
-        return ['.', '..'] + [x[1:] for x in self.direntry if x != '/']
+        header = self.dirs.lookup(path)
+        if header is None:
+            raise FuseOSError(ENOENT)
+        if not is_dir(header):
+            raise FuseOSError(ENOTDIR)
+        entries = self.dirs.load(header['attrs']['vnode']) or {}
+        return ['.', '..'] + [name for name in entries if name != '.']
 
     def readlink(self, path):
         if DEBUG: print("readlink: path={}".format(path),file=DEBUG_FILE)
-        return self.data[path]['contents']
+        contents = self.data[path]['contents']
+        return contents.read(0, len(contents))
 
     def release(self, path, fh):
         if DEBUG: print("release: path={} : fh: {}".format(path,fh),file=DEBUG_FILE)
 
-        if DEBUG: print("       : counter={} dirty={} blocks={} header={}".format(  self.data[path]["counter"],
-                                                                          self.data[path]["dirty"],
-                                                                          self.__blocks(len(self.data[path]["contents"])),
-                                                                          self.direntry[path]),file=DEBUG_FILE)
-        
-        self.data[path]["counter"] -= 1
-        
-        if self.data[path]["counter"] <= 0:
-            data = self.data[path]["contents"]
-            dirty = self.data[path]["dirty"]
-            self.data.pop(path)
-
-
-            self.__write_file(self.__get_vnode(path),data,dirty)
+        with self.lock:
+            odict = self.data[path]
+            odict["counter"] -= 1
+            if DEBUG: print("       : counter={} dirty={} blocks={}".format(  odict["counter"],
+                                                                              sorted(odict["contents"].dirty),
+                                                                              self.__blocks(len(odict["contents"]))),file=DEBUG_FILE)
+            if odict["counter"] > 0:
+                return
+
+        #write back without holding self.lock, so other files carry on
+        with odict["contents"].lock:
+            self.__write_back(odict["vnode"],odict["contents"])
+
+        #unless it was opened again meanwhile (maybe renamed, too)
+        with self.lock:
+            if odict["counter"] <= 0:
+                for p in [p for p, d in self.data.items() if d is odict]:
+                    del self.data[p]
 
                     
+    @synchronized
     def removexattr(self, path, name):
         if DEBUG: print("removexattr: path={} name={}".format(path,name),file=DEBUG_FILE)
                 
-        attrs = self.direntry[path].get('attrs',{})
-        try:
-            del attrs[name]
-        except KeyError:
-            pass        # Should return ENODATA
+        if name == 'vnode':
+            return
+        if name == ETA_XATTR:
+            raise FuseOSError(EPERM)
+        self.__change(path, lambda header: header.get('attrs',{}).pop(name, None))
+        # Should return ENODATA when missing
         
 
+    @synchronized
     def rename(self, old, new):
         if DEBUG: print("rename: old={} new={}".format(old,new),file=DEBUG_FILE)
-        self.direntry[new] = self.direntry.pop(old)
+        odvnode, oentries, oname = self.__locate(old)
+        loc = self.dirs.locate(new)
+        if loc is None:
+            raise FuseOSError(ENOENT)
+        ndvnode, nentries, nname = loc
+        if nname in nentries and (odvnode, oname) != (ndvnode, nname):
+            #replacing an existing file or (empty) directory
+            if is_dir(nentries[nname]):
+                self.rmdir(new)
+            else:
+                self.unlink(new)
+        header = oentries.pop(oname)
+        nentries[nname] = header
+        self.dirs.mark(odvnode)
+        self.dirs.mark(ndvnode)
+        if is_dir(header) and odvnode != ndvnode:
+            self.__add_link(old, -1)
+            self.__add_link(new, 1)
+
+        #open files inside a renamed directory move along with it
+        for path in [p for p in self.data if p == old or p.startswith(old + '/')]:
+            self.data[new + path[len(old):]] = self.data.pop(path)
         self.__write_direntry()#write on renames?
         
-    # def rmdir(self, path):
-    #     self.files.pop(path)
-    #     self.files['/']['st_nlink'] -= 1
+    @synchronized
+    def rmdir(self, path):
+        if DEBUG: print("rmdir: path={}".format(path),file=DEBUG_FILE)
+        dvnode, entries, name = self.__locate(path)
+        header = entries[name]
+        if not is_dir(header):
+            raise FuseOSError(ENOTDIR)
+        vnode = header['attrs']['vnode']
+        contents = self.dirs.load(vnode)
+        if contents is None:
+            # can't tell whether it's empty
+            raise FuseOSError(EIO)
+        if contents:
+            raise FuseOSError(ENOTEMPTY)
+        del entries[name]
+        self.dirs.mark(dvnode)
+        self.dirs.forget(vnode)
+        self.woo.delete(vnode)
+        self.__add_link(path, -1)
 
+    @synchronized
     def setxattr(self, path, name, value, options, position=0):
         if DEBUG: print("setxattr: path={} name={} value={} options={}".format(path,name,value,options),file=DEBUG_FILE)
-        header = self.__get_header(path)
-        attrs = header.setdefault('attrs', {})
-        attrs[name] = value
+        if name == ETA_XATTR:
+            raise FuseOSError(EPERM)
+        self.__change(path, lambda header: header.setdefault('attrs', {}).__setitem__(name, value))
         
     def statfs(self, path):
         if DEBUG: print("statfs: path={}".format(path),file=DEBUG_FILE)
@@ -355,33 +602,38 @@ class ObliviSyncRW(LoggingMixIn, Operations):
 
     def truncate(self, path, length, fh=None):
         if DEBUG: print("truncate: path={} length={}".format(path,length),file=DEBUG_FILE)
-              
-        self.data[path]["contents"] = self.data[path]["contents"][:length]
-                
-        #slice up dirty to similar length
-        self.data[path]["dirty"] = self.data[path]["dirty"][:self.__blocks(length)]
 
-        #if truncated into a middle of block, last block is dirty
-        if length % self.bs:
-            self.data[path]["dirty"][-1] = 1 
+        with self.lock:
+            odict = self.data.get(path)
+            vnode = self.__get_vnode(path) if odict is None else odict["vnode"]
 
-        self.woo.resize(self.__get_vnode(path),length)
-        if DEBUG: print("resiz: {} : new_bsize: {}".format(path,len(self.data[path]["dirty"])),file=DEBUG_FILE)
+        #only the fragments at the new end become dirty
+        if odict is None:
+            self.woo.resize(vnode,length)
+        else:
+            with odict["contents"].lock:
+                odict["contents"].truncate(length)
+                self.woo.resize(vnode,length)
+        if DEBUG: print("resiz: {} : new_bsize: {}".format(path,self.__blocks(length)),file=DEBUG_FILE)
 
         
 
+    @synchronized
     def unlink(self, path):
         if DEBUG: print("unlink: path={}".format(path),file=DEBUG_FILE)
         #read directory entry get vnode
-        vnode = self.__get_vnode(path)
+        dvnode, entries, name = self.__locate(path)
+        vnode = entries[name]['attrs']['vnode']
 
         #delete in wooram
         self.woo.delete(vnode)
 
         #remove from cache
-        self.direntry.pop(path)
+        del entries[name]
+        self.dirs.mark(dvnode)
         self.__write_direntry() #write on remove?
         
+    @synchronized
     def utimens(self, path, times=None):
         if DEBUG: print("utimens: path={} times={}".format(path,times),file=DEBUG_FILE)
         now = time()
@@ -393,60 +645,63 @@ class ObliviSyncRW(LoggingMixIn, Operations):
 
     def write(self, path, data, offset, fh):
         if DEBUG: print("write: path={} len(data)={} offset={} fh={}".format(path,len(data), offset, fh),file=DEBUG_FILE)
-        
-        old_contents = self.data[path]["contents"]
 
-        new_contents = self.data[path]["contents"][:offset] + data
-        
-        #everything that changed is dirty
-        old_dirty = self.data[path]["dirty"]
-        new_dirty = []
-        for i in range(0, self.__blocks(len(new_contents))):
-
-            #originally empty, always dirty
-            if len(old_contents) == 0:
-                new_dirty.append(1)
-            elif i*self.bs < len(old_contents):
-                if new_contents[i*self.bs:(i+1)*self.bs] != old_contents[i*self.bs:(i+1)*self.bs]:
-                    new_dirty.append(1)
-                else:
-                    new_dirty.append(0)
-            else:
-                new_dirty.append(1)
+        #only the fragments written to become dirty
+        odict = self.__open_file(path)
+        contents = odict["contents"]
+        with contents.lock:
+            contents.write(offset, data)
 
+            #the writer has moved past any earlier dirty fragments, so they
+            #are complete: hand them to the wooram to start dripping now,
+            #instead of holding them in memory until release
+            self.__write_back(odict["vnode"],contents,offset // self.bs)
+        self.__trim()
 
-        self.data[path]["contents"] = new_contents
-        
-        old_dirty.extend([0]*(len(new_dirty)-len(old_dirty)))
-        self.data[path]["dirty"] = [1 if any(d) else 0 for d in zip(new_dirty,old_dirty)]
-
-        if DEBUG: print("     : OLD DIRTY: {} NEW DIRTY: {}".format(old_dirty,new_dirty),file=DEBUG_FILE)
-        if DEBUG: print("     : FINISH: dirty: {}  size: {}".format(self.data[path]["dirty"],
-                                                          len(self.data[path]['contents'])),file=DEBUG_FILE)
+        if DEBUG: print("     : FINISH: dirty: {}  size: {}".format(sorted(contents.dirty),
+                                                          len(contents)),file=DEBUG_FILE)
 
         return len(data)
 
 
-class ObliviSyncRO(LoggingMixIn, Operations):
-    'Example memory filesystem. Supports only one level of files.'
+class ObliviSyncRO(InstrumentMixIn, Operations):
+    'Example memory filesystem. Each directory is stored in its own vnode.'
 
-    def __init__(self, backdir='dbox', key=b'0123456789abcdef', thresh=3):
+    def __init__(self, backdir='dbox', key=b'0123456789abcdef', thresh=3, backend=None,
+                 open_mem=2**28,open_min=2**24,readahead=8):
+        super().__init__(trace_rate=trace_rate, trace_file=DEBUG_FILE,
+                         record_file=record_file)
+
+        #open files holding more than open_min bytes are trimmed, biggest
+        #first, once all together hold more than open_mem
+        self.open_mem = open_mem
+        self.open_min = open_min
+
+        if backend is None:
+            backend = Backend(key, backdir)
         
         #load wooram get directory table and the wooram
-        self.woo = load_rooram(Backend(key, backdir))
+        self.woo = load_rooram(backend)
         
         #store blocksize
         self.bs = self.woo.fbsize
 
-        self.__thresh_dir = thresh #should be sit to drip rate
-        self.__last_dir = 0
-        self.direntry = self.__read_direntry()
-        self.data = {} # (content, counter, dirty)
+        #directories are re-read once older than thresh seconds, which
+        #should be set to the drip rate
+        self.dirs = Directories(self.woo, ttl=thresh)
+        self.data = {} # (contents as a FileBuffer, counter, header)
+        self.lock = threading.RLock() # see synchronized
+
+        #sequential reads fetch up to readahead fragments ahead, from
+        #the vtable as loaded by the read that triggered it
+        self.readahead = Readahead(lambda keys: self.woo.get_many(keys,update=False),
+                                   readahead)
         self.fd = 0
 
-        if DEBUG: print(self.direntry,file=DEBUG_FILE)
+        root = self.dirs.load(ROOT)
+        if DEBUG: print(root,file=DEBUG_FILE)
         
-        if self.direntry == None: # first mount
+        if root == None: # first mount
             raise FuseOSError(EROFS)
 
     def __del__(self):
@@ -456,43 +711,30 @@ class ObliviSyncRO(LoggingMixIn, Operations):
 
 
     def __get_vnode(self,path):
-        if path in self.direntry:
-            return self.direntry[path]['attrs']['vnode']
+        header = self.dirs.lookup(path)
+        if header is not None:
+            return header['attrs']['vnode']
         return None
 
-    
-    def __read_file(self,vnode):
-        #what if woo.get() returns None?
+    def __read_fragments(self,vnode,boffs):
+        #against the vtable as loaded by the read that needs them
         try:
-            return b''.join(self.woo.get(vnode,i) for i in range(self.woo.num_blocks(vnode,update=False)))
-        except:
-            return b'' #empty if we get a none?
+            return self.woo.get_many([(vnode,i) for i in boffs],update=False)
+        except (KeyError, IndexError):
+            return [None]*len(boffs) #changed since it was opened
 
     def __write_file(self,vnode,data,dirty): raise FuseOSError(EROFS)
 
-    def __read_direntry(self):
-
-        #see if we need to update
-        now = time()
-        if not now-self.__last_dir > self.__thresh_dir:
-            return self.direntry
-
-        if DEBUG: print("header: reading header from backend: diff: {}".format(now-self.__last_dir),file=DEBUG_FILE)
-        data = self.__read_file(1)
-        if len(data) == 0: return None
-        direntry = pickle.loads(data)
-        self.__last_dir = now
-        
-        #load in mtime and size without further updates
-        for path in direntry:
-            vnode = direntry[path]["attrs"]["vnode"]
-            direntry[path]["st_mtime"] = self.woo.get_mtime(vnode,update=False)
-            direntry[path]["st_size"] = self.woo.get_size(vnode,update=False)
-            
-            
-        return direntry
+    def __trim(self):
+        #over the memory budget, drop fragments of the biggest open files
+        with self.lock:
+            files = {path: odict["contents"] for path, odict in self.data.items()}
+        trim(files, self.open_mem, self.open_min)
 
-                
+    def __new_fd(self):
+        with self.lock:
+            self.fd += 1
+            return self.fd
 
     # def __write_direntry(self):
     #     data = pickle.dumps(self.direntry)
@@ -505,25 +747,28 @@ class ObliviSyncRO(LoggingMixIn, Operations):
 
     def __get_header(self,path):
 
-        #if already open, must be in entry
+        #if already open, use the header from then
         if path in self.data:
-            return self.direntry[path]
+            return self.data[path]["header"]
 
-        #otherwise try and see if we need to update
-        self.direntry = self.__read_direntry()
+        #otherwise look it up, re-reading directories if need be
+        header = self.dirs.lookup(path)
+        if header is None: return None
 
-        if not self.direntry: return None #error condition when
-                                          #reading in the middle of an
-                                          #update and get empty string
-
-        #return the entry or none
-        return self.direntry[path] if path in self.direntry else None
+        #load in mtime and size without further updates
+        vnode = header["attrs"]["vnode"]
+        try:
+            return dict(header, st_mtime=self.woo.get_mtime(vnode,update=False),
+                        st_size=self.woo.get_size(vnode,update=False))
+        except KeyError:
+            return None #error condition when reading in the middle of an update
 
     def chmod(self, path, mode): raise FuseOSError(EROFS)
     def chown(self, path, uid, gid): raise FuseOSError(EROFS)
     def create(self, path, mode): raise FuseOSError(EROFS)
 
 
+    @synchronized
     def getattr(self, path, fh=None):
         if DEBUG: print("getattr: path={}".format(path),file=DEBUG_FILE)
         header = self.__get_header(path)
@@ -532,6 +777,7 @@ class ObliviSyncRO(LoggingMixIn, Operations):
         if DEBUG: print("       : header={}".format(header),file=DEBUG_FILE)
         return header
 
+    @synchronized
     def getxattr(self, path, name, position=0):
         if DEBUG: print("getxattr: path={} name={}".format(path,name),file=DEBUG_FILE)
         header = self.__get_header(path)
@@ -541,78 +787,92 @@ class ObliviSyncRO(LoggingMixIn, Operations):
         except KeyError:
             raise FuseOSError(ENODATA)
 
+    @synchronized
     def listxattr(self, path):
         if DEBUG: print("listxattr: path={}".format(path),file=DEBUG_FILE)
         header = self.__get_header(path)
         attrs = header.get('attrs',{})
         return [k for k in attrs.keys() if k != 'vnode'] #vnode could be removed by another application!
 
-    # def mkdir(self, path, mode):
-    #     self.files[path] = dict(st_mode=(S_IFDIR | mode), st_nlink=2,
-    #                             st_size=0, st_ctime=time(), st_mtime=time(),
-    #                             st_atime=time())
-
-    #     self.files['/']['st_nlink'] += 1
+    def mkdir(self, path, mode): raise FuseOSError(EROFS)
 
+    @synchronized
     def open(self, path, flags):
         if DEBUG: print("open: path={} flags={}".format(path,flags),file=DEBUG_FILE)
-        self.fd += 1
 
         if flags & (O_WRONLY | O_RDWR | O_APPEND): raise FuseOSError(EROFS)
 
         #read directory entry
-        self.direntry = self.__read_direntry()
-        vnode = self.__get_vnode(path)
+        header = self.__get_header(path)
+        if header is None:
+            raise FuseOSError(ENOENT)
+        vnode = header['attrs']['vnode']
         odict = self.data.setdefault(path,{})
         
         #set counter and load blocks if need be
         odict.setdefault("counter",0)
         if odict["counter"] == 0:
 
-            
-            data = self.__read_file(vnode)
-            dirty = [0 for _ in range(self.__blocks(len(data)))]
-            odict['contents']=data
-            odict['dirty'] = dirty
-
-            #still syncing, something off?
-            if len(odict['contents']) != self.direntry[path]['st_size']:
-                raise FuseOSError(EIO)
+            #fragments are only fetched when first read; one that is
+            #still syncing (missing or the wrong size) gives EIO then
+            odict['header'] = header
+            odict['vnode'] = vnode
+            odict['contents'] = FileBuffer(self.bs, header['st_size'],
+                                           lambda boffs: self.__read_fragments(vnode,boffs))
             
         odict["counter"]+=1 #increment counter
 
-        if DEBUG: print(" open: {} : dirty: {} header: {}".format(path,self.data[path]["dirty"],
-                                                        self.direntry[path]),file=DEBUG_FILE)
+        if DEBUG: print(" open: {} : header: {}".format(path,
+                                                        header),file=DEBUG_FILE)
                   
         #set dirty flag based on flags
 
-        return self.fd
+        return self.__new_fd()
 
     def read(self, path, size, offset, fh):
         if DEBUG: print("read: path={} size={} offset={}  fh={}".format(path,size,offset,fh),file=DEBUG_FILE)
-        return self.data[path]["contents"][offset:offset + size]
-
+        #one vtable snapshot for all the fragments this read loads; cheap
+        #unless the superblock has changed
+        with self.lock:
+            odict = self.data[path]
+        contents = odict["contents"]
+        with contents.lock:
+            self.woo.supdate()
+            res = contents.read(offset, size)
+        self.readahead.after_read(fh, contents, odict["vnode"], offset, len(res))
+        self.__trim()
+        return res
+
+    @synchronized
     def readdir(self, path, fh):
         if DEBUG: print("readdir: path={}".format(path),file=DEBUG_FILE)
-        self.direntry = self.__read_direntry()
-        return ['.', '..'] + [x[1:] for x in self.direntry if x != '/']
+        header = self.dirs.lookup(path)
+        if header is None:
+            raise FuseOSError(ENOENT)
+        if not is_dir(header):
+            raise FuseOSError(ENOTDIR)
+        entries = self.dirs.load(header['attrs']['vnode']) or {}
+        return ['.', '..'] + [name for name in entries if name != '.']
 
     def readlink(self, path):
         if DEBUG: print("readlink: path={}".format(path),file=DEBUG_FILE)
-        return self.data[path]['contents']
+        contents = self.data[path]['contents']
+        return contents.read(0, len(contents))
 
     def release(self, path, fh):
         if DEBUG: print("release: path={} : fh: {}".format(path,fh),file=DEBUG_FILE)
 
-        if DEBUG: print("       : counter={} dirty={} blocks={} header={}".format(  self.data[path]["counter"],
-                                                                          self.data[path]["dirty"],
+        if DEBUG: print("       : counter={} loaded={} blocks={} header={}".format(  self.data[path]["counter"],
+                                                                          self.data[path]["contents"].loaded(),
                                                                           self.__blocks(len(self.data[path]["contents"])),
-                                                                          self.direntry[path]),file=DEBUG_FILE)
-        
-        self.data[path]["counter"] -= 1
+                                                                          self.data[path]["header"]),file=DEBUG_FILE)
         
-        if self.data[path]["counter"] <= 0:
-            self.data.pop(path)
+        self.readahead.forget(fh)
+        with self.lock:
+            self.data[path]["counter"] -= 1
+
+            if self.data[path]["counter"] <= 0:
+                self.data.pop(path)
 
                     
     def removexattr(self, path, name): raise FuseOSError(EROFS)
@@ -636,17 +896,13 @@ class ObliviSyncRO(LoggingMixIn, Operations):
 
     def write(self, path, data, offset, fh):  raise FuseOSError(EROFS)        
 
-def getkey(dirname):
-    pwstring = getpass.getpass("Enter passphrase for directory {}: ".format(dirname))
-    hasher = hashlib.new('sha256')
-    hasher.update(bytes(pwstring, 'utf8'))
-    key = hasher.digest()[:16]
-    return key
-
 if __name__ == '__main__':
 
     backdir,mountdir,key,readwrite = parse_args()
     if readwrite:
-        fuse = FUSE(ObliviSyncRW(backdir, key,drip_rate=drip_rate,drip_time=drip_time), mountdir, foreground=True)
+        fuse = FUSE(ObliviSyncRW(backdir, key,drip_rate=drip_rate,drip_time=drip_time,spill_dir=spill_dir,wal_dir=wal_dir,
+                                 open_mem=open_mem,open_min=open_min,dir_interval=dir_interval,dedup=dedup,policy=policy,repack=repack,slots=slots),
+                    mountdir, foreground=True)
     else:
-        fuse = FUSE(ObliviSyncRO(backdir, key), mountdir, foreground=True)
+        fuse = FUSE(ObliviSyncRO(backdir, key,open_mem=open_mem,open_min=open_min,readahead=readahead),
+                    mountdir, foreground=True)
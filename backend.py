@@ -1,4 +1,6 @@
 import os
+import getpass
+import hashlib
 from Crypto.Cipher import AES
 from Crypto.Hash import HMAC, SHA256
 from rwlock import get_rw_locks
@@ -8,11 +10,45 @@ readSize = 1048576
 
 class BackendError(Exception): pass    
 
+class Cipher:
+    """Authenticated encryption of byte strings under a single key."""
+    #Key should be a 16 byte array or 16 length string
+    def __init__(self, key):
+        self.key = key
+
+    def encrypt(self, plaintext):
+        iv = os.urandom(16)
+
+        cipher = AES.new(self.key, AES.MODE_CFB, iv)
+        ciphertext = iv + cipher.encrypt(plaintext)
+
+        hmac = HMAC.new(self.key, digestmod=SHA256)
+        hmac.update(ciphertext)
+        mac = hmac.digest()
+
+        return mac + ciphertext
+
+    def decrypt(self, ciphertext):
+        mac = ciphertext[:32]
+        ciphertext = ciphertext[32:]
+        hmac = HMAC.new(self.key, digestmod=SHA256)
+        hmac.update(ciphertext)
+        testmac = hmac.digest()
+
+        if mac != testmac:
+            raise BackendError("MAC verification failed!")
+
+        iv = ciphertext[:16]
+        ciphertext = ciphertext[16:]
+
+        cipher = AES.new(self.key, AES.MODE_CFB, iv)
+        return cipher.decrypt(ciphertext)
+
 @LRUlist(10)
-class Backend:
+class Backend(Cipher):
     #Key should be a 16 byte array or 16 length string
     def __init__(self, key, directory):
-        self.key = key
+        super().__init__(key)
         self.directory = directory
 
         files = os.listdir(directory)
@@ -58,16 +94,18 @@ class Backend:
             return self.decrypt(contents)
 
     def __setitem__(self, index, data):
+        if index < 0:
+            raise IndexError("index out of bounds for backend")
+
+        # encrypted and written outside the lock, so that different
+        # blocks can be written by several threads at once
+        dest = os.path.join(self.directory, str(index))
+        tdest = dest + '.temp'
+        with open(tdest, "wb") as f:
+            f.write(self.encrypt(data))
         with self.wlock:
-            if index < 0:
-                raise IndexError("index out of bounds for backend")
-            elif index >= self.length:
+            if index >= self.length:
                 self.length = index+1
-
-            dest = os.path.join(self.directory, str(index))
-            tdest = dest + '.temp'
-            with open(tdest, "wb") as f:
-                f.write(self.encrypt(data))
             os.replace(tdest, dest)
 
     #Expects an array of byte arrays to extend the storage with, 
@@ -83,33 +121,12 @@ class Backend:
             self.length += 1
             self[self.length-1] = newdata
 
-    def encrypt(self, plaintext):
-        iv = os.urandom(16)
-
-        cipher = AES.new(self.key, AES.MODE_CFB, iv)
-        ciphertext = iv + cipher.encrypt(plaintext)
-
-        hmac = HMAC.new(self.key, digestmod=SHA256)
-        hmac.update(ciphertext)
-        mac = hmac.digest()
-
-        return mac + ciphertext
-
-    def decrypt(self, ciphertext):
-        mac = ciphertext[:32]
-        ciphertext = ciphertext[32:]
-        hmac = HMAC.new(self.key, digestmod=SHA256)
-        hmac.update(ciphertext)
-        testmac = hmac.digest()
-
-        if mac != testmac:
-            raise BackendError("MAC verification failed!")
-
-        iv = ciphertext[:16]
-        ciphertext = ciphertext[16:]
-
-        cipher = AES.new(self.key, AES.MODE_CFB, iv)
-        return cipher.decrypt(ciphertext)
-
     def __len__(self):
         return self.length
+
+def getkey(dirname):
+    pwstring = getpass.getpass("Enter passphrase for directory {}: ".format(dirname))
+    hasher = hashlib.new('sha256')
+    hasher.update(bytes(pwstring, 'utf8'))
+    key = hasher.digest()[:16]
+    return key
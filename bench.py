@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import struct
+import getopt
+import itertools
+import tempfile
+
+from membackend import MemBackend
+from superblock import new_superblock
+from wooram import WoOram
+
+USAGE = """{} [OPTIONS]
+Benchmarks WoOram operations and sync rounds, printing one JSON object
+per parameter combination.
+
+OPTIONS
+    -h      \t: print this help screen
+    -b list \t: block sizes to try (dflt: 65536,262144)
+    -n list \t: total number of blocks N to try (dflt: 1024)
+    -k list \t: drip rates K to try (dflt: 3,10)
+    -m list \t: fragment size mixes to try, from {} (dflt: all)
+    -f num  \t: number of files to write in each run (dflt: 200)
+    -s num  \t: random seed (dflt: 1985)
+    -r dir  \t: use a real (encrypted) Backend in a fresh subdirectory of dir
+    -o file \t: append results to file (dflt: stdout)
+""".format(sys.argv[0], "full,small,mixed")
+
+def file_sizes(mix, fbsize, count, rand):
+    """Returns a list of count file sizes, in bytes, following the named mix."""
+    if mix == "full":
+        # every fragment is full
+        return [fbsize * rand.randrange(1, 5) for _ in range(count)]
+    elif mix == "small":
+        # single small fragments, which get packed into split blocks
+        return [rand.randrange(1, fbsize // 32) for _ in range(count)]
+    elif mix == "mixed":
+        # roughly log-normal, from a few bytes to several fragments
+        return [max(1, min(8*fbsize, int(rand.lognormvariate(0, 2) * fbsize / 8)))
+                for _ in range(count)]
+    else:
+        raise ValueError("unknown fragment size mix: " + mix)
+
+class Payloads:
+    """Makes distinct fragment contents cheaply, by stamping a counter
+    on the front of a fixed block of random bytes."""
+    def __init__(self, fbsize):
+        self.pool = os.urandom(fbsize)
+        self.counter = itertools.count()
+
+    def make(self, size):
+        stamp = struct.pack(">Q", next(self.counter))
+        return (stamp + self.pool[len(stamp):size])[:size]
+
+def rate(count, nbytes, elapsed):
+    return dict(ops=count, seconds=elapsed,
+            ops_per_s=count/elapsed if elapsed else None,
+            bytes_per_s=nbytes/elapsed if elapsed else None)
+
+def run(blocksize, N, K, mix, nfiles, seed, realdir=None):
+    """Runs one benchmark and returns its results as a dict."""
+    rand = random.Random(seed)
+    random.seed(seed) # for the eviction choices in sync
+    if realdir is None:
+        back = MemBackend()
+    else:
+        from backend import Backend
+        back = Backend(bytes(rand.randrange(256) for _ in range(16)),
+                tempfile.mkdtemp(dir=realdir))
+    woo = WoOram(back, new_superblock(blocksize, N, 48), K, 0)
+    fb = woo.fbsize
+    pay = Payloads(fb)
+    res = dict(backend="memory" if realdir is None else "Backend",
+            blocksize=blocksize, N=N, K=K, mix=mix, files=nfiles, fbsize=fb)
+
+    # set: write whole files
+    files = {}
+    count = nbytes = 0
+    start = time.perf_counter()
+    for size in file_sizes(mix, fb, nfiles, rand):
+        vnode = woo.new()
+        for boff in range((size + fb - 1) // fb):
+            data = pay.make(min(fb, size - boff*fb))
+            woo.set(vnode, boff, data)
+            count += 1
+            nbytes += len(data)
+        files[vnode] = size
+    res["set"] = rate(count, nbytes, time.perf_counter() - start)
+
+    def time_gets(label):
+        keys = [(v, rand.randrange(woo.num_blocks(v))) for v in
+                rand.choices(list(files), k=min(1000, 4*len(files)))]
+        nbytes = 0
+        start = time.perf_counter()
+        for vnode, boff in keys:
+            nbytes += len(woo.get(vnode, boff))
+        res[label] = rate(len(keys), nbytes, time.perf_counter() - start)
+
+    time_gets("get_buffered")
+
+    # sync until the buffer is empty (or clearly can't be emptied)
+    limit = 100 * N
+    rounds = 0
+    start = time.perf_counter()
+    while len(woo.buf) and rounds < limit:
+        woo.sync()
+        rounds += 1
+    elapsed = time.perf_counter() - start
+    res["drain"] = dict(rounds=rounds, seconds=elapsed, complete=not woo.buf,
+            rounds_per_s=rounds/elapsed if elapsed else None)
+    res["sync"] = woo.sync_stats()
+    res["utilization"] = woo.size() / woo.capacity()
+
+    time_gets("get_synced")
+
+    # resize: truncate or extend every file by a random amount
+    start = time.perf_counter()
+    for vnode, size in files.items():
+        newsize = max(1, size + rand.randrange(-size, fb))
+        woo.resize(vnode, newsize)
+        files[vnode] = newsize
+    res["resize"] = rate(len(files), 0, time.perf_counter() - start)
+
+    # delete everything
+    start = time.perf_counter()
+    for vnode in files:
+        woo.delete(vnode)
+    res["delete"] = rate(len(files), 0, time.perf_counter() - start)
+
+    return res
+
+def intlist(arg):
+    return [int(x, 0) for x in arg.split(",")]
+
+if __name__ == '__main__':
+    blocksizes = [2**16, 2**18]
+    Ns = [2**10]
+    Ks = [3, 10]
+    mixes = ["full", "small", "mixed"]
+    nfiles = 200
+    seed = 1985
+    realdir = None
+    out = sys.stdout
+
+    opt, args = getopt.getopt(sys.argv[1:], "hb:n:k:m:f:s:r:o:")
+    for o, v in opt:
+        if o == "-h":
+            print(USAGE)
+            exit(0)
+        if o == "-b":
+            blocksizes = intlist(v)
+        if o == "-n":
+            Ns = intlist(v)
+        if o == "-k":
+            Ks = intlist(v)
+        if o == "-m":
+            mixes = v.split(",")
+        if o == "-f":
+            nfiles = int(v)
+        if o == "-s":
+            seed = int(v)
+        if o == "-r":
+            realdir = v
+        if o == "-o":
+            out = open(v, "a")
+
+    for blocksize, N, K, mix in itertools.product(blocksizes, Ns, Ks, mixes):
+        res = run(blocksize, N, K, mix, nfiles, seed, realdir)
+        res["time"] = time.time()
+        print(json.dumps(res, sort_keys=True), file=out)
+        out.flush()
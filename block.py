@@ -42,6 +42,11 @@ class Block:
         else:
             return 0
 
+    def fits(self, size):
+        """whether a fragment of the given size could be added"""
+        return ((self._kind == self.EMPTY and size > self.woo.split_maxsize)
+                or size <= self.space_avail())
+
     def add_if(self, vnode, boff, data):
         """if it fits, add it and return True. Else return False."""
         if self._kind == self.EMPTY and len(data) > self.woo.split_maxsize:
@@ -1,38 +1,148 @@
 #!/usr/bin/env python3
 
+import time
 import collections
 
+class _Spilled:
+    """Stands in for a fragment whose bytes were moved to the spill log."""
+    __slots__ = ("loc", "length")
+
+    def __init__(self, loc, length):
+        self.loc = loc
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
 class Buffer:
-    def __init__(self):
+    def __init__(self, spill=None, mem_limit=2**28, spill_min=2**16):
+        """spill, if given, is a SegmentLog where cold fragments are moved
+        once more than mem_limit bytes are held in memory.
+        Fragments smaller than spill_min always stay in memory."""
         self.lst = collections.OrderedDict() # (vnode, boff) -> data
 
+        self.spill = spill
+        self.mem_limit = mem_limit
+        self.spill_min = spill_min
+        self.nbytes = 0 # bytes of fragment data in the buffer
+        self.memsize = 0 # bytes of fragment data held in memory
+        self.resident = collections.OrderedDict() # spillable keys, oldest first
+        self.seglive = collections.Counter() # segno -> # of live spilled fragments
+        self.since = {} # (vnode, boff) -> when it was first buffered
+        if spill is not None:
+            spill.clear()
+
     def __len__(self):
         return len(self.lst)
 
     def size(self):
-        return sum(len(d) for d in self.lst.values())
+        return self.nbytes
+
+    def __contains__(self, key):
+        return key in self.lst
 
     def get(self, vnode, boff):
         try:
-            return self.lst[vnode,boff]
+            data = self.lst[vnode,boff]
         except KeyError:
             return None
+        if type(data) is _Spilled:
+            try:
+                return self.spill.read(data.loc)
+            except (KeyError, OSError):
+                # popped and its segment removed in the meantime
+                return None
+        return data
 
     def set(self, vnode, boff, data):
+        key = (vnode, boff)
         try:
-            self.lst.move_to_end((vnode,boff))
+            self.lst.move_to_end(key)
+            self._forget(key, self.lst[key])
         except KeyError:
-            pass
-        self.lst[vnode, boff] = data
+            self.since[key] = time.time()
+        self.lst[key] = data
+        self.nbytes += len(data)
+        self.memsize += len(data)
+        if self.spill is not None and len(data) >= self.spill_min:
+            self.resident[key] = None
+            if self.memsize > self.mem_limit:
+                self._spill_cold()
+
+    def _forget(self, key, data):
+        """Accounts for data (stored under key) leaving the buffer."""
+        self.nbytes -= len(data)
+        if type(data) is _Spilled:
+            segno = data.loc[0]
+            self.seglive[segno] -= 1
+            if self.seglive[segno] <= 0:
+                del self.seglive[segno]
+                if segno != self.spill.current():
+                    self.spill.remove(segno)
+        else:
+            self.memsize -= len(data)
+            self.resident.pop(key, None)
+
+    def _spill_cold(self):
+        """Moves the oldest spillable fragments out of memory until
+        the memory limit is respected."""
+        while self.memsize > self.mem_limit and self.resident:
+            key, _ = self.resident.popitem(False)
+            data = self.lst[key]
+            loc = self.spill.append(data)
+            if loc[1] == 0:
+                # just started a new segment; drop old ones that are dead
+                for segno in list(self.spill.segnos):
+                    if segno != loc[0] and not self.seglive[segno]:
+                        self.spill.remove(segno)
+            self.lst[key] = _Spilled(loc, len(data))
+            self.seglive[loc[0]] += 1
+            self.memsize -= len(data)
+
+    def pending(self):
+        """Returns a list of (vnode, boff, size) tuples for everything
+        in the buffer, in FIFO order. Unlike available(), this never
+        reads back spilled data."""
+        return [(v,b,len(d)) for ((v,b),d) in self.lst.items()]
+
+    def ages(self, now=None):
+        """Returns how long (in seconds) each buffered fragment has been
+        waiting, in FIFO order. A fragment set again keeps its age."""
+        if now is None: now = time.time()
+        return [now - self.since[key] for key in self.lst]
+
+    def backlog(self, vnode):
+        """Returns (nbytes, nfrags, ahead, since) for the fragments of
+        vnode in the buffer: their total size and number, how many bytes
+        are buffered up to and including the last of them in FIFO order,
+        and when the oldest was buffered (None if there are none)."""
+        nbytes = nfrags = total = ahead = 0
+        since = None
+        for (v,b),d in self.lst.items():
+            total += len(d)
+            if v == vnode:
+                nbytes += len(d)
+                nfrags += 1
+                ahead = total
+                when = self.since[v,b]
+                since = when if since is None else min(since, when)
+        return nbytes, nfrags, ahead, since
 
     def available(self):
         """Returns an list of (vnode, boff, data) tuples that
         can be popped, in FIFO order."""
-        return [(v,b,d) for ((v,b),d) in self.lst.items()]
+        return [(v,b,self.get(v,b)) for (v,b) in self.lst]
 
     def pop(self, items, sync=False):
         """Given a list of (vnode, boff) pairs, removes those items from the
         buffer."""
         for x in items:
             if x in self.lst:
-                del self.lst[x]
+                self._forget(x, self.lst.pop(x))
+                del self.since[x]
+
+    def close(self):
+        """Releases the spill log, if any."""
+        if self.spill is not None:
+            self.spill.clear()
+            self.spill.close()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import getopt
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_IFDIR, S_IFREG, S_IMODE, S_ISREG
+
+from backend import Backend, getkey
+from block import Block
+from directory import Directories, ROOT
+from superblock import new_superblock, calc_sizes
+from wooram import WoOram, _holds_split
+
+DEBUG=False
+
+USAGE = """{} [OPTIONS] <source> <backend>
+Copies the directory tree source into a new, empty backend directory at
+disk and encryption speed, instead of through a mount at the drip rate:
+fragments are packed densely into consecutive blocks, encrypted by a pool
+of threads, and the directories and superblock are written once, at the
+end. Only use it before the backend has ever been shared, since anyone
+watching the backend while it fills learns the size of every file.
+
+OPTIONS
+    -h      \t: print this help screen
+    -b num  \t: backend block size (dflt: 4194304)
+    -n num  \t: backend total blocks (dflt: 1024)
+    -S num  \t: fragments per backend block (dflt: 2)
+    -j num  \t: threads encrypting and writing blocks (dflt: number of CPUs)
+    -m num  \t: bytes of small fragments held back to pack together (dflt: 268435456)
+    -x      \t: don't write the unused blocks (which otherwise hide how much was imported)
+    -v      \t: print each file imported
+""".format(sys.argv[0])
+
+class Importer:
+    """Stores files in a fresh backend without the buffer or sync rounds
+    of a WoOram, whose vtable and block format it uses.
+
+    Full fragments fill the slots of one block after another, and each
+    block is written as soon as it is full. Small fragments are held
+    until tail_mem bytes of them are waiting, then packed largest first
+    (best fit) into split slots. Blocks are encrypted and written by a
+    pool of threads; finish() writes the directories, then the
+    superblock.
+
+    Directories are kept in a Directories object that is given the
+    Importer itself in place of a WoOram, so they are stored as files.
+    """
+
+    def __init__(self, backend, sup, threads=None, tail_mem=2**28):
+        self.backend = backend
+        self.woo = WoOram(backend, sup, 1, 0)
+        self.fbsize = self.woo.fbsize
+        self.pool = ThreadPoolExecutor(threads or os.cpu_count())
+        self.writes = deque() # blocks being written, oldest first
+        self.max_writes = 2 * self.pool._max_workers
+        self.next = 1 # the next backend index to fill
+        self.open = [] # lists of Blocks not yet written
+        self.tails = [] # (size, vnode, boff, data) of small fragments waiting
+        self.tail_bytes = 0
+        self.tail_mem = tail_mem
+        self.nbytes = 0 # bytes of fragments stored
+        self.used = 0 # blocks holding fragments, once finished
+
+        # directories are written through set(), like files
+        self.dirs = Directories(self)
+        now = time.time()
+        self.dirs.create(ROOT, {".": dict(st_mode=(S_IFDIR | 0o755), st_ctime=now,
+            st_mtime=now, st_atime=now, st_nlink=2, attrs={"vnode": ROOT})})
+
+    def new(self):
+        return self.woo.new()
+
+    def set_mtime(self, vnode, when=None):
+        self.woo.set_mtime(vnode, when)
+
+    def set(self, vnode, boff, data):
+        self.woo.vtable.change_inode(vnode, boff, len(data))
+        self.nbytes += len(data)
+        if len(data) > self.woo.split_maxsize:
+            blist = self._slots_block()
+            blist[[b.kind() for b in blist].index(Block.EMPTY)].add_if(vnode, boff, data)
+            if all(b.kind() != Block.EMPTY for b in blist):
+                self.open.remove(blist)
+                self._write(blist)
+        else:
+            self.tails.append((len(data), vnode, boff, data))
+            self.tail_bytes += len(data)
+            if self.tail_bytes > self.tail_mem:
+                self._pack_tails()
+
+    def add_file(self, vnode, f):
+        """Stores the contents of the open (binary) file f in vnode."""
+        boff = 0
+        while True:
+            data = f.read(self.fbsize)
+            if not data:
+                break
+            self.set(vnode, boff, data)
+            boff += 1
+
+    def finish(self, pad=True):
+        """Writes everything still held, the directories and then the
+        superblock. With pad, the unused blocks are written too, empty,
+        so that the backend doesn't show how much is stored."""
+        self.dirs.flush()
+        self._pack_tails()
+        while self.open:
+            self._write(self.open.pop(0))
+        self.used = self.next - 1
+        if pad:
+            while self.next < self.woo.N:
+                self._write([Block(self.woo, Block.EMPTY) for _ in range(self.woo.slots)])
+        while self.writes:
+            self.writes.popleft().result()
+        self.woo._save_superblock()
+        self.pool.shutdown()
+
+    def _slots_block(self):
+        """The last open block, or a new one if it has no EMPTY slot."""
+        if not self.open or Block.EMPTY not in [b.kind() for b in self.open[-1]]:
+            self.open.append([Block(self.woo, Block.EMPTY) for _ in range(self.woo.slots)])
+        return self.open[-1]
+
+    def _pack_tails(self):
+        """Packs every waiting small fragment into split slots, largest
+        first, then writes the blocks that are left with no EMPTY slot."""
+        self.tails.sort(key=lambda t: -t[0])
+        for size, vnode, boff, data in self.tails:
+            best = None
+            for blist in self.open:
+                if _holds_split(blist, vnode):
+                    continue
+                for b in blist:
+                    if (b.kind() == Block.SPLIT and b.fits(size)
+                            and (best is None or b.space_avail() < best.space_avail())):
+                        best = b
+            if best is None:
+                blist = self._slots_block()
+                if _holds_split(blist, vnode):
+                    blist = [Block(self.woo, Block.EMPTY) for _ in range(self.woo.slots)]
+                    self.open.append(blist)
+                best = blist[[b.kind() for b in blist].index(Block.EMPTY)]
+            best.add_if(vnode, boff, data)
+        self.tails = []
+        self.tail_bytes = 0
+        for blist in [bl for bl in self.open if Block.EMPTY not in [b.kind() for b in bl]]:
+            self.open.remove(blist)
+            self._write(blist)
+
+    def _write(self, blist):
+        """Assigns the next backend index to a list of Blocks, records
+        where its fragments are and hands it to the pool to write."""
+        ind = self.next
+        if ind >= self.woo.N:
+            raise ValueError("backend is too small: all {} blocks are full".format(self.woo.N))
+        self.next += 1
+        for j, b in enumerate(blist):
+            for vnode, boff in b.added():
+                self.woo.vtable.set_inode(vnode, boff, self.woo.slots*ind + j)
+        if len(self.writes) >= self.max_writes:
+            self.writes.popleft().result()
+        self.writes.append(self.pool.submit(self.backend.__setitem__,
+            ind, self.woo._make_block(blist)))
+        if DEBUG: print("bulkimport: block {} written".format(ind), file=sys.stderr)
+
+def _xattrs(path):
+    """The extended attributes of path, as a mount would store them."""
+    try:
+        return {name: os.getxattr(path, name, follow_symlinks=False)
+                for name in os.listxattr(path, follow_symlinks=False)}
+    except (OSError, AttributeError):
+        return {}
+
+def import_tree(imp, source, verbose=False):
+    """Adds every directory and regular file under source to the Importer
+    imp, at the same paths. Anything else (symlinks, devices...) is
+    skipped with a warning. Returns the number of files imported."""
+    dirents = {source: imp.dirs.cache[ROOT]} # source directory -> entries
+    nfiles = 0
+    for dirpath, dirnames, filenames in os.walk(source):
+        entries = dirents[dirpath]
+        for name in sorted(dirnames):
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if os.path.islink(path):
+                print("WARNING: skipping symlink", path, file=sys.stderr)
+                continue
+            vnode = imp.new()
+            entries[name] = dict(st_mode=(S_IFDIR | S_IMODE(st.st_mode)), st_nlink=2,
+                    st_ctime=st.st_ctime, st_atime=st.st_atime,
+                    attrs=dict(_xattrs(path), vnode=vnode))
+            dirents[path] = {}
+            imp.dirs.create(vnode, dirents[path])
+            # a subdirectory's '..' links to its parent
+            parent = entries['.'] if dirpath == source else dirents[os.path.dirname(dirpath)][os.path.basename(dirpath)]
+            parent['st_nlink'] += 1
+        dirnames[:] = [name for name in sorted(dirnames)
+                if os.path.join(dirpath, name) in dirents]
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if not S_ISREG(st.st_mode):
+                print("WARNING: skipping", path, "(not a regular file)", file=sys.stderr)
+                continue
+            vnode = imp.new()
+            with open(path, "rb") as f:
+                imp.add_file(vnode, f)
+            imp.set_mtime(vnode, st.st_mtime)
+            entries[name] = dict(st_mode=(S_IFREG | S_IMODE(st.st_mode)), st_nlink=1,
+                    st_ctime=st.st_ctime, st_atime=st.st_atime,
+                    attrs=dict(_xattrs(path), vnode=vnode))
+            nfiles += 1
+            if verbose: print(path[len(source):] or "/", file=sys.stderr)
+    return nfiles
+
+if __name__ == '__main__':
+    blocksize = 2**22
+    N = 2**10
+    slots = 2
+    threads = None
+    tail_mem = 2**28
+    pad = True
+    verbose = False
+
+    opt, args = getopt.getopt(sys.argv[1:], "hb:n:S:j:m:xv")
+    for o, v in opt:
+        if o == "-h":
+            print(USAGE)
+            exit(0)
+        if o == "-b":
+            blocksize = int(v, 0)
+        if o == "-n":
+            N = int(v, 0)
+        if o == "-S":
+            slots = int(v)
+        if o == "-j":
+            threads = int(v)
+        if o == "-m":
+            tail_mem = int(v, 0)
+        if o == "-x":
+            pad = False
+        if o == "-v":
+            verbose = True
+    if len(args) != 2:
+        print(USAGE)
+        exit(1)
+    try:
+        calc_sizes(blocksize, 48, slots)
+    except ValueError as e:
+        print("ERROR:", e, file=sys.stderr)
+        print(USAGE)
+        exit(1)
+    source, backdir = os.path.abspath(args[0]), args[1]
+
+    os.makedirs(backdir, exist_ok=True)
+    if os.path.exists(os.path.join(backdir, "0")):
+        print("ERROR: {} already holds a volume".format(backdir), file=sys.stderr)
+        exit(1)
+    key = getkey(backdir)
+
+    start = time.time()
+    imp = Importer(Backend(key, backdir), new_superblock(blocksize, N, 48, slots),
+            threads, tail_mem)
+    try:
+        nfiles = import_tree(imp, source, verbose)
+        imp.finish(pad)
+    except ValueError as e:
+        print("ERROR:", e, file=sys.stderr)
+        exit(1)
+    elapsed = time.time() - start
+    print("Imported {} files ({} bytes) into {} of {} blocks in {:.1f}s".format(
+        nfiles, imp.nbytes, imp.used, N - 1, elapsed))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+
+class DedupIndex:
+    """Finds fragments with identical contents, by a keyed hash.
+
+    Holds the hash of the current contents of every full fragment set
+    since it was created, whether still buffered or already synced. The
+    key is random and never stored, so the hashes are of no use to anyone
+    who sees them, and nobody can choose data to collide with another's.
+    Callers must call drop whenever a fragment changes or goes away.
+    """
+
+    def __init__(self):
+        self.key = os.urandom(32)
+        self.holders = {} # digest -> {(vnode, boff): None}, oldest first
+        self.digests = {} # (vnode, boff) -> digest
+
+    def __len__(self):
+        return len(self.digests)
+
+    def digest(self, data):
+        return hashlib.blake2b(data, key=self.key).digest()
+
+    def find(self, digest):
+        """Some (vnode, boff) whose contents have the given digest, or None."""
+        for key in self.holders.get(digest, ()):
+            return key
+        return None
+
+    def add(self, vnode, boff, digest):
+        self.drop(vnode, boff)
+        self.digests[vnode, boff] = digest
+        self.holders.setdefault(digest, {})[vnode, boff] = None
+
+    def drop(self, vnode, boff):
+        digest = self.digests.pop((vnode, boff), None)
+        if digest is not None:
+            keys = self.holders[digest]
+            del keys[vnode, boff]
+            if not keys:
+                del self.holders[digest]
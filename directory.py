@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import time
+import pickle
+
+from errno import EIO
+from stat import S_ISDIR
+
+ROOT = 1 # vnode of the root directory
+
+class Directories:
+    """Directory contents, loaded from the wooram on demand and cached.
+
+    Each directory is stored in its own vnode as a pickled dict mapping
+    names to headers (the stat fields, plus attrs whose 'vnode' says where
+    the file or directory is stored). The root's dict also holds the
+    root's own header, under '.'.
+
+    With a ttl, cached directories are re-read once they are older than
+    ttl seconds (for read-only mounts, where another client may change
+    them); otherwise they stay cached until forgotten.
+    """
+
+    def __init__(self, woo, ttl=None):
+        self.woo = woo
+        self.ttl = ttl
+        self.cache = {} # vnode -> entries dict
+        self.loaded = {} # vnode -> when it was read
+        self.saved = {} # vnode -> serialized contents as last read or written
+        self.changed = set() # vnodes whose contents need writing back
+
+    @staticmethod
+    def split(path):
+        """Returns the parent path and the name within it."""
+        parent, _, name = path.rpartition('/')
+        return (parent or '/'), name
+
+    def load(self, vnode):
+        """Returns the entries dict of the given directory vnode,
+        or None if it is empty or can't be read right now."""
+        entries = self.cache.get(vnode)
+        if entries is not None and (self.ttl is None or vnode in self.changed
+                or time.time() - self.loaded[vnode] <= self.ttl):
+            return entries
+        data = self._read(vnode)
+        if data is None:
+            return entries # keep the old copy, if any
+        try:
+            entries = pickle.loads(data)
+        except Exception:
+            return self.cache.get(vnode)
+        if vnode == ROOT and '/' in entries:
+            # older volumes kept every path in one flat dict
+            entries = {('.' if path == '/' else path[1:]): header
+                    for (path, header) in entries.items()}
+            if self.ttl is None:
+                self.changed.add(vnode)
+        self.cache[vnode] = entries
+        self.loaded[vnode] = time.time()
+        self.saved[vnode] = data
+        return entries
+
+    def create(self, vnode, entries):
+        """Caches the entries of a new directory, to be written back."""
+        self.cache[vnode] = entries
+        self.loaded[vnode] = time.time()
+        self.saved[vnode] = b''
+        self.changed.add(vnode)
+
+    def forget(self, vnode):
+        """Drops a directory that was deleted."""
+        self.cache.pop(vnode, None)
+        self.loaded.pop(vnode, None)
+        self.saved.pop(vnode, None)
+        self.changed.discard(vnode)
+
+    def locate(self, path):
+        """Returns (dvnode, entries, name) such that entries, the contents of
+        directory dvnode, holds the header for path (if it exists) under
+        name. Returns None if the parent directory doesn't exist, and
+        raises OSError(EIO) if it can't be read."""
+        if path == '/':
+            entries = self.load(ROOT)
+            return None if entries is None else (ROOT, entries, '.')
+        parent, name = self.split(path)
+        header = self.lookup(parent)
+        if header is None or not is_dir(header):
+            return None
+        dvnode = header['attrs']['vnode']
+        entries = self.load(dvnode)
+        if entries is None:
+            # not an empty directory: anything added would be lost
+            raise OSError(EIO, "directory {} is unavailable".format(parent))
+        return dvnode, entries, name
+
+    def lookup(self, path):
+        """Returns the header for path, or None if it doesn't exist."""
+        loc = self.locate(path)
+        if loc is None:
+            return None
+        dvnode, entries, name = loc
+        return entries.get(name)
+
+    def mark(self, dvnode):
+        """Notes that the given directory changed."""
+        self.changed.add(dvnode)
+
+    def flush(self):
+        """Writes back every changed directory, setting only the fragments
+        that differ from what was last written."""
+        changed, self.changed = self.changed, set()
+        fbsize = self.woo.fbsize
+        for vnode in sorted(changed):
+            entries = self.cache.get(vnode)
+            if entries is None:
+                continue
+            data = pickle.dumps(entries)
+            old = self.saved.get(vnode, b'')
+            self.saved[vnode] = data
+            if len(data) < len(old):
+                self.woo.resize(vnode, len(data))
+            self.woo.set_mtime(vnode)
+            for i in range(-(-len(data) // fbsize)):
+                frag = data[i*fbsize:(i+1)*fbsize]
+                if frag != old[i*fbsize:(i+1)*fbsize]:
+                    self.woo.set(vnode, i, frag)
+
+    def _read(self, vnode):
+        try:
+            frags = self.woo.get_many([(vnode, i) for i in range(self.woo.num_blocks(vnode))])
+        except (KeyError, IndexError):
+            return None
+        if not frags or None in frags:
+            return None
+        return b''.join(frags)
+
+def is_dir(header):
+    return S_ISDIR(header['st_mode'])
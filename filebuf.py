@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import threading
+
+from errno import EIO
+
+# stands in for a fragment of null bytes past the old end of the file,
+# which the wooram stores as a hole; it is clean, and made in memory
+HOLE = object()
+
+class FileBuffer:
+    """The contents of an open file, held as a list of mutable fragments
+    of fbsize bytes each (the last may be shorter), along with the set of
+    fragment indices that changed since they were last written back.
+
+    A file of the given size starts with no fragments in memory; each is
+    fetched the first time it is needed, with loader(boffs), which is given
+    a list of fragment indices (all those a read needs at once) and returns
+    a list of their bytes. A fragment that comes back None, because it is
+    unavailable, raises OSError(EIO).
+
+    Its methods don't lock; threads sharing a buffer hold its lock
+    while using it."""
+
+    def __init__(self, fbsize, size=0, loader=None):
+        self.fbsize = fbsize
+        self.size = size
+        self.frags = [None] * (-(-size // fbsize)) # None (or HOLE) until loaded
+        self.loader = loader
+        self.dirty = set()
+        self.nloaded = 0 # number of fragments held in memory
+        self.recent = None # the fragment most recently touched
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return self.size
+
+    def fragment(self, boff):
+        """The current contents of the given fragment, as bytes."""
+        return bytes(self._frag(boff))
+
+    def loaded(self):
+        """The number of bytes of fragments held in memory."""
+        return sum(len(f) for f in self.frags if type(f) is bytearray)
+
+    def memsize(self):
+        """About how much memory the loaded fragments take (an upper bound)."""
+        return self.nloaded * self.fbsize
+
+    def read(self, offset, size):
+        end = min(offset + size, self.size)
+        if end > offset:
+            self._load(range(offset // self.fbsize, (end - 1) // self.fbsize + 1))
+        res = []
+        while offset < end:
+            boff, pos = divmod(offset, self.fbsize)
+            chunk = self._frag(boff)[pos:pos + end - offset]
+            res.append(chunk)
+            offset += len(chunk)
+        return b''.join(res)
+
+    def write(self, offset, data):
+        """Writes data at offset, filling any gap past the end with null
+        bytes. Only the fragments touched become dirty."""
+        if offset > self.size:
+            self._extend(offset)
+        view = memoryview(data)
+        while view:
+            boff, pos = divmod(offset, self.fbsize)
+            n = min(len(view), self.fbsize - pos)
+            if boff == len(self.frags):
+                self.frags.append(bytearray())
+                self.nloaded += 1
+            elif pos == 0 and n >= self._length(boff) and type(self.frags[boff]) is not bytearray:
+                # overwritten completely, so no need to load it
+                self.frags[boff] = bytearray()
+                self.nloaded += 1
+            self._frag(boff)[pos:pos + n] = view[:n]
+            self.dirty.add(boff)
+            offset += n
+            view = view[n:]
+        self.size = max(self.size, offset)
+
+    def truncate(self, length):
+        if length > self.size:
+            self._extend(length)
+        elif length < self.size:
+            num = -(-length // self.fbsize)
+            self.nloaded -= sum(1 for f in self.frags[num:] if type(f) is bytearray)
+            del self.frags[num:]
+            self.dirty = {boff for boff in self.dirty if boff < num}
+            if length % self.fbsize and self.frags[num - 1] is not HOLE:
+                del self._frag(num - 1)[length % self.fbsize:]
+                self.dirty.add(num - 1)
+            self.size = length
+
+    def fill(self, boff, data):
+        """Installs a fragment fetched ahead of time, unless it is already
+        loaded or data doesn't fit. Returns whether it was used."""
+        if (boff >= len(self.frags) or type(self.frags[boff]) is bytearray
+                or data is None or len(data) != self._length(boff)):
+            return False
+        self.frags[boff] = bytearray(data)
+        self.nloaded += 1
+        return True
+
+    def take_dirty(self, before=None):
+        """Returns the sorted dirty fragment indices (only those less than
+        before, if given) and marks them clean."""
+        res = sorted(boff for boff in self.dirty if before is None or boff < before)
+        self.dirty.difference_update(res)
+        return res
+
+    def evict(self, boff):
+        """Drops a clean fragment from memory; it is loaded again if needed."""
+        assert boff not in self.dirty
+        if type(self.frags[boff]) is bytearray:
+            self.frags[boff] = None
+            self.nloaded -= 1
+
+    def spill(self):
+        """Drops every fragment except the most recently touched one from
+        memory. They must all be clean. Returns the new memsize()."""
+        for boff in range(len(self.frags)):
+            if boff != self.recent:
+                self.evict(boff)
+        return self.memsize()
+
+    def _length(self, boff):
+        """The current length of the given fragment."""
+        return min(self.fbsize, self.size - boff*self.fbsize)
+
+    def _frag(self, boff):
+        """The given fragment as a bytearray, loading it if necessary."""
+        if type(self.frags[boff]) is not bytearray:
+            self._load([boff])
+        self.recent = boff
+        return self.frags[boff]
+
+    def _load(self, boffs):
+        """Loads those of the given fragments that aren't in memory."""
+        missing = []
+        for boff in boffs:
+            if self.frags[boff] is HOLE:
+                self.frags[boff] = bytearray(self._length(boff))
+                self.nloaded += 1
+            elif self.frags[boff] is None:
+                missing.append(boff)
+        if not missing:
+            return
+        for boff, data in zip(missing, self.loader(missing)):
+            if data is None or len(data) != self._length(boff):
+                raise OSError(EIO, "fragment {} is unavailable".format(boff))
+            self.frags[boff] = bytearray(data)
+            self.nloaded += 1
+
+    def _extend(self, length):
+        """Pads with null bytes up to the given length. New fragments are
+        holes, which don't need writing back."""
+        while self.size < length:
+            boff, pos = divmod(self.size, self.fbsize)
+            n = min(length - self.size, self.fbsize - pos)
+            if boff == len(self.frags):
+                self.frags.append(HOLE)
+            else:
+                self._frag(boff).extend(bytes(n))
+                self.dirty.add(boff)
+            self.size += n
+
+def trim(files, budget, threshold, write_back=None):
+    """Keeps the memory held by open files within budget bytes.
+    files maps names to FileBuffers. The ones holding the most are spilled
+    first (see FileBuffer.spill), but never one holding less than
+    threshold bytes. A file with dirty fragments is first passed to
+    write_back(name), which must write them all back and mark them clean,
+    so they can be loaded again later. Files whose lock is held by
+    another thread are skipped rather than waited for."""
+    held = sorted(((buf.memsize(), name) for (name, buf) in files.items()),
+            reverse=True)
+    total = sum(size for (size, name) in held)
+    for size, name in held:
+        if total <= budget or size < threshold:
+            break
+        buf = files[name]
+        if not buf.lock.acquire(blocking=False):
+            continue
+        try:
+            if buf.dirty:
+                write_back(name)
+            total -= size - buf.spill()
+        finally:
+            buf.lock.release()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import random
+import getopt
+import resource
+import tempfile
+import contextlib
+import tracemalloc
+import collections
+import multiprocessing
+
+from os import O_RDONLY, O_RDWR
+from time import perf_counter
+
+from membackend import MemBackend
+from metrics import percentile
+import ObliviSync
+
+USAGE = """{} [OPTIONS] [workload ...]
+Benchmarks the ObliviSync FUSE operations directly, without a kernel mount,
+printing one JSON object per workload. Each workload runs in a process of
+its own, so max_rss_kib is the peak of that workload alone. The ro_ workloads fill a volume
+through ObliviSyncRW, sync it completely, and then time only the reads
+made through an ObliviSyncRO mounted over it.
+
+Workloads: {}  (dflt: all)
+
+OPTIONS
+    -h      \t: print this help screen
+    -b num  \t: backend block size (dflt: 4194304)
+    -n num  \t: backend total blocks (dflt: 1024)
+    -s num  \t: scale factor for the workload sizes (dflt: 1)
+    -t num  \t: drip time; 0 means no sync thread (dflt: 0)
+    -r dir  \t: use a real (encrypted) Backend in a fresh subdirectory of dir
+    -M      \t: also trace Python memory allocations (slower)
+    -o file \t: append results to file (dflt: stdout)
+"""
+
+CHUNK = 128 * 2**10
+
+class Harness:
+    """Calls FUSE operations on an Operations object, timing each one."""
+
+    def __init__(self, fs):
+        self.fs = fs
+        self.lat = collections.defaultdict(list) # op -> [seconds]
+        self.nbytes = 0
+
+    def __call__(self, op, *args):
+        start = perf_counter()
+        res = self.fs(op, *args)
+        self.lat[op].append(perf_counter() - start)
+        if op == "read":
+            self.nbytes += len(res)
+        elif op == "write":
+            self.nbytes += len(args[1])
+        return res
+
+    def report(self):
+        res = {}
+        for op, times in self.lat.items():
+            times.sort()
+            res[op] = dict(count=len(times), mean=sum(times)/len(times),
+                    p50=percentile(times, .5), p90=percentile(times, .9),
+                    p99=percentile(times, .99), max=times[-1])
+        return res
+
+def payload(size, rand):
+    return bytes(rand.getrandbits(8) for _ in range(min(size, 64))) + b'.'*max(0, size-64)
+
+def small_files(call, rand, scale):
+    """Many small files, each created, written once and closed."""
+    for i in range(int(1000*scale)):
+        path = "/small{}".format(i)
+        fh = call("create", path, 0o644)
+        call("write", path, payload(rand.randrange(1, 16*2**10), rand), 0, fh)
+        call("release", path, fh)
+
+def write_file(call, path, size, rand):
+    fh = call("create", path, 0o644)
+    for off in range(0, size, CHUNK):
+        call("write", path, payload(min(CHUNK, size-off), rand), off, fh)
+    call("release", path, fh)
+
+def read_file(call, path, size, flags=O_RDONLY):
+    fh = call("open", path, flags)
+    for off in range(0, size, CHUNK):
+        call("read", path, CHUNK, off, fh)
+    call("release", path, fh)
+
+def read_random(call, path, size, count, rand, flags=O_RDONLY):
+    fh = call("open", path, flags)
+    for _ in range(count):
+        call("read", path, rand.randrange(1, CHUNK), rand.randrange(size), fh)
+    call("release", path, fh)
+
+def sequential(call, rand, scale):
+    """One large file written and then read back in 128 KiB chunks."""
+    size = int(64 * 2**20 * scale)
+    write_file(call, "/large", size, rand)
+    read_file(call, "/large", size)
+
+def random_reads(call, rand, scale):
+    """Random reads of up to 128 KiB from a file that is opened once."""
+    size = int(16 * 2**20 * scale)
+    write_file(call, "/rand", size, rand)
+    read_random(call, "/rand", size, int(2000*scale), rand, O_RDWR)
+
+def metadata_storm(call, rand, scale):
+    """Creating, renaming, chmodding and unlinking lots of empty files."""
+    paths = []
+    for i in range(int(500*scale)):
+        path = "/meta{}".format(i)
+        call("release", path, call("create", path, 0o644))
+        paths.append(path)
+    for i, path in enumerate(paths):
+        call("getattr", path)
+        call("chmod", path, 0o600)
+        newpath = "/renamed{}".format(i)
+        call("rename", path, newpath)
+        paths[i] = newpath
+    call("readdir", "/", 0)
+    for path in paths:
+        call("unlink", path)
+
+def tree(call, rand, scale):
+    """Ten directories of small files, for ro_metadata."""
+    for d in range(10):
+        call("mkdir", "/dir{}".format(d), 0o755)
+        for i in range(int(50*scale)):
+            write_file(call, "/dir{}/file{}".format(d, i),
+                    rand.randrange(1, 16*2**10), rand)
+
+def ro_metadata(call, rand, scale):
+    """Listing every directory, then getattr, open and release on every file."""
+    for d in call("readdir", "/", 0):
+        if d.startswith("dir"):
+            for name in call("readdir", "/" + d, 0):
+                if name not in (".", ".."):
+                    path = "/{}/{}".format(d, name)
+                    call("getattr", path)
+                    call("release", path, call("open", path, O_RDONLY))
+
+WORKLOADS = collections.OrderedDict([
+    ("small_files", small_files),
+    ("sequential", sequential),
+    ("random_reads", random_reads),
+    ("metadata_storm", metadata_storm),
+])
+
+# name -> (fills the volume through RW, untimed; the reads timed through RO)
+RO_WORKLOADS = collections.OrderedDict([
+    ("ro_sequential", (
+        lambda call, rand, scale: write_file(call, "/large", int(64 * 2**20 * scale), rand),
+        lambda call, rand, scale: read_file(call, "/large", int(64 * 2**20 * scale)))),
+    ("ro_random_reads", (
+        lambda call, rand, scale: write_file(call, "/rand", int(16 * 2**20 * scale), rand),
+        lambda call, rand, scale: read_random(call, "/rand", int(16 * 2**20 * scale),
+            int(2000*scale), rand))),
+    ("ro_metadata", (tree, ro_metadata)),
+])
+
+def run(name, blocksize, N, scale, drip_time, realdir, trace_mem):
+    """Runs one workload against a fresh volume and returns its results."""
+    rand = random.Random(1985)
+    if realdir is None:
+        back = MemBackend()
+    else:
+        from backend import Backend
+        back = Backend(bytes(16), tempfile.mkdtemp(dir=realdir))
+    if name in RO_WORKLOADS:
+        fill, work = RO_WORKLOADS[name]
+        # filled and synced without a sync thread, so RO sees all of it
+        with contextlib.redirect_stdout(sys.stderr):
+            rw = ObliviSync.ObliviSyncRW(backend=back, blocksize=blocksize,
+                    total_blocks=N, drip_time=0)
+            fill(rw, rand, scale)
+            rw("destroy", "/")
+            while not rw.woo.idle():
+                rw.woo.sync()
+            rw.woo.finish()
+            fs = ObliviSync.ObliviSyncRO(backend=back)
+    else:
+        work = WORKLOADS[name]
+        with contextlib.redirect_stdout(sys.stderr):
+            fs = ObliviSync.ObliviSyncRW(backend=back, blocksize=blocksize,
+                    total_blocks=N, drip_time=drip_time)
+    call = Harness(fs)
+    if trace_mem:
+        tracemalloc.start()
+    start = perf_counter()
+    work(call, rand, scale)
+    elapsed = perf_counter() - start
+    res = dict(workload=name, blocksize=blocksize, N=N, scale=scale,
+            drip_time=drip_time, backend="memory" if realdir is None else "Backend",
+            seconds=elapsed, ops=sum(len(t) for t in call.lat.values()),
+            bytes=call.nbytes)
+    if name not in RO_WORKLOADS:
+        res["buffered_bytes"] = fs.woo.buf.size()
+    res["ops_per_s"] = res["ops"] / elapsed
+    res["bytes_per_s"] = res["bytes"] / elapsed
+    res["latency"] = call.report()
+    if trace_mem:
+        res["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    res["max_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if name not in RO_WORKLOADS:
+        with contextlib.redirect_stdout(sys.stderr):
+            fs.woo.finish() # with a sync thread, this waits for the drip
+    return res
+
+if __name__ == '__main__':
+    blocksize = 2**22
+    N = 2**10
+    scale = 1
+    drip_time = 0
+    realdir = None
+    trace_mem = False
+    out = sys.stdout
+
+    opt, args = getopt.getopt(sys.argv[1:], "hb:n:s:t:r:Mo:")
+    for o, v in opt:
+        if o == "-h":
+            print(USAGE.format(sys.argv[0], ", ".join(list(WORKLOADS) + list(RO_WORKLOADS))))
+            exit(0)
+        if o == "-b":
+            blocksize = int(v, 0)
+        if o == "-n":
+            N = int(v, 0)
+        if o == "-s":
+            scale = float(v)
+        if o == "-t":
+            drip_time = int(v)
+        if o == "-r":
+            realdir = v
+        if o == "-M":
+            trace_mem = True
+        if o == "-o":
+            out = open(v, "a")
+
+    for name in args or list(WORKLOADS) + list(RO_WORKLOADS):
+        # a fresh process each time, as ru_maxrss never goes down
+        with multiprocessing.Pool(1) as pool:
+            res = pool.apply(run, (name, blocksize, N, scale, drip_time, realdir, trace_mem))
+        res["time"] = time.time()
+        print(json.dumps(res, sort_keys=True), file=out)
+        out.flush()
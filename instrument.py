@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import random
+import threading
+
+from errno import EACCES, ENODATA, ENOENT
+from stat import S_IFDIR, S_IFREG
+from time import time, perf_counter
+
+from fuse import FuseOSError
+from metrics import Histogram
+from optrace import TraceRecorder
+
+STATS_DIR = "/.oblivisync"
+STATS_FILE = STATS_DIR + "/stats"
+TRACE_XATTR = "user.oblivisync.trace_rate"
+
+class _OpStats:
+    __slots__ = ("errors", "nbytes", "latency")
+
+    def __init__(self):
+        self.errors = 0
+        self.nbytes = 0
+        self.latency = Histogram()
+
+def _describe(arg):
+    """Short form of an operation argument for traces; never the payload."""
+    if isinstance(arg, (bytes, bytearray)):
+        return "<{} bytes>".format(len(arg))
+    elif isinstance(arg, (int, float, str)) or arg is None:
+        return repr(arg)
+    else:
+        return "<{}>".format(type(arg).__name__)
+
+class InstrumentMixIn:
+    """Records the count, latency and bytes moved of every FUSE operation,
+    and optionally traces a random sample of them (without payloads).
+
+    The numbers can be read from the virtual file STATS_FILE inside
+    the mount, and tracing can be switched on at runtime by setting
+    the TRACE_XATTR attribute of that file to the fraction of
+    operations to trace.
+
+    If record_file is given, every operation is also recorded there
+    (again without payloads) so it can be replayed by replay.py.
+    """
+
+    def __init__(self, trace_rate=0, trace_file=sys.stderr, record_file=None):
+        super().__init__()
+        self.trace_rate = trace_rate
+        self.trace_file = trace_file
+        self.recorder = None if record_file is None else TraceRecorder(record_file)
+        self.__ops = {} # op name -> _OpStats
+        self.__lock = threading.Lock()
+        self.__rendered = (0, b"")
+        self.__started = time()
+
+    def __call__(self, op, path, *args):
+        if path == STATS_DIR or (path and path.startswith(STATS_DIR + "/")):
+            return self.__stats_op(op, path, *args)
+        start = perf_counter()
+        when = time()
+        failed = False
+        ret = None
+        try:
+            ret = super().__call__(op, path, *args)
+            if op == "readdir" and path == "/":
+                ret = list(ret) + [STATS_DIR[1:]]
+            return ret
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            if op == "write" and args:
+                nbytes = len(args[0])
+            elif op == "read" and isinstance(ret, bytes):
+                nbytes = len(ret)
+            else:
+                nbytes = 0
+            with self.__lock:
+                try:
+                    stats = self.__ops[op]
+                except KeyError:
+                    stats = self.__ops[op] = _OpStats()
+                stats.latency.add(elapsed)
+                stats.nbytes += nbytes
+                if failed: stats.errors += 1
+            if self.trace_rate and random.random() < self.trace_rate:
+                print("trace: {} {} ({}) -> {} in {:.6f}s".format(op, path,
+                        ", ".join(_describe(a) for a in args),
+                        "error" if failed else _describe(ret), elapsed),
+                        file=self.trace_file)
+            if self.recorder is not None:
+                self.recorder.record(when, op, path, args, ret, failed)
+                if op == "destroy":
+                    self.recorder.close()
+
+    def op_stats(self):
+        """Returns a dict mapping op names to dicts of their count, errors,
+        bytes moved and latency (in seconds) distribution."""
+        with self.__lock:
+            res = {}
+            for op, stats in self.__ops.items():
+                res[op] = stats.latency.summary()
+                res[op].update(errors=stats.errors, bytes=stats.nbytes)
+            return res
+
+    def __render(self):
+        """Current contents of the stats file. Re-rendered at most once a
+        second, so that getattr and read see the same size."""
+        when, text = self.__rendered
+        now = time()
+        if now - when > 1:
+            report = dict(uptime=now - self.__started, ops=self.op_stats(),
+                    trace_rate=self.trace_rate)
+            woo = getattr(self, "woo", None)
+            if hasattr(woo, "sync_stats"):
+                report["sync"] = woo.sync_stats()
+            if hasattr(woo, "backlog"):
+                report["backlog"] = woo.backlog()
+            text = (json.dumps(report, indent=1, sort_keys=True) + "\n").encode()
+            self.__rendered = (now, text)
+        return text
+
+    def __stats_op(self, op, path, *args):
+        if op == "getattr":
+            if path == STATS_DIR:
+                return dict(st_mode=(S_IFDIR | 0o555), st_nlink=2,
+                        st_ctime=self.__started, st_mtime=self.__started, st_atime=time())
+            elif path == STATS_FILE:
+                now = time()
+                return dict(st_mode=(S_IFREG | 0o444), st_nlink=1,
+                        st_size=len(self.__render()), st_ctime=now, st_mtime=now, st_atime=now)
+            raise FuseOSError(ENOENT)
+        elif op == "readdir" and path == STATS_DIR:
+            return [".", "..", STATS_FILE[len(STATS_DIR)+1:]]
+        elif op in ("open", "release", "opendir", "releasedir", "access", "flush"):
+            return 0
+        elif op == "read" and path == STATS_FILE:
+            size, offset = args[0], args[1]
+            return self.__render()[offset:offset+size]
+        elif op == "listxattr":
+            return [TRACE_XATTR] if path == STATS_FILE else []
+        elif op == "getxattr" and path == STATS_FILE and args[0] == TRACE_XATTR:
+            return str(self.trace_rate).encode()
+        elif op == "getxattr":
+            raise FuseOSError(ENODATA)
+        elif op == "setxattr" and path == STATS_FILE and args[0] == TRACE_XATTR:
+            try:
+                self.trace_rate = float(args[1])
+            except ValueError:
+                raise FuseOSError(EACCES)
+            return 0
+        raise FuseOSError(EACCES)
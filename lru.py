@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import collections
+import threading
 import time
 
 def LRUlist(defcache=-1):
@@ -33,6 +34,9 @@ def LRUlist(defcache=-1):
                 if self.__max_cache is None:
                     self.__max_cache = defcache
                 self.__cache = collections.OrderedDict()
+                # only guards the cache; lookups that miss it, and writes to
+                # given keys, run in parallel
+                self.__lock = threading.RLock()
 
                 if not hasattr(self, '_is_stale'):
                     # default _is_stale never expires anything
@@ -54,71 +58,81 @@ def LRUlist(defcache=-1):
             def __maybe_evict(self):
                 """Check size of cache and possibly evict whatever was least recently
                 used."""
-                if self.__max_cache > 0:
-                    while len(self.__cache) > self.__max_cache:
-                        self.__cache.popitem(False)
+                with self.__lock:
+                    if self.__max_cache > 0:
+                        while len(self.__cache) > self.__max_cache:
+                            self.__cache.popitem(False)
 
             def __getitem__(self, key):
                 try:
-                    res, timestamp = self.__cache[key]
+                    with self.__lock:
+                        res, timestamp = self.__cache[key]
                     stale = self._is_stale(key, timestamp)
                 except KeyError:
                     stale = True
                 if stale:
                     res = super().__getitem__(key)
-                    self.__cache[key] = (res, time.time())
-                    self.__maybe_evict()
-                self.__cache.move_to_end(key)
+                    with self.__lock:
+                        self.__cache[key] = (res, time.time())
+                        self.__maybe_evict()
+                with self.__lock:
+                    if key in self.__cache:
+                        self.__cache.move_to_end(key)
                 return res
 
             def __setitem__(self, key, val):
                 super().__setitem__(key, val)
-                self.__cache[key] = (val, time.time())
-                self.__maybe_evict()
+                with self.__lock:
+                    self.__cache[key] = (val, time.time())
+                    self.__maybe_evict()
 
             def __contains__(self, key):
-                return key in self.__cache or super().__contains__(key)
+                with self.__lock:
+                    if key in self.__cache:
+                        return True
+                return super().__contains__(key)
 
             def __delitem__(self, key):
-                try:
-                    del self.__cache[key]
-                except KeyError:
-                    pass
+                with self.__lock:
+                    self.__cache.pop(key, None)
                 super().__delitem__(key)
 
             def clear(self):
-                super().clear()
-                self.__cache.clear()
+                with self.__lock:
+                    super().clear()
+                    self.__cache.clear()
 
+            # these change the length, which the keys cached depend on
             def pop(self, key=None, *args):
-                if key is None:
-                    key = super().__len__() - 1
-                res = super().pop(key, *args)
-                try:
-                    del self.__cache[key]
-                except KeyError:
-                    pass
+                with self.__lock:
+                    if key is None:
+                        key = super().__len__() - 1
+                    res = super().pop(key, *args)
+                    self.__cache.pop(key, None)
 
             def append(self, val):
-                super().append(val)
-                self.__cache[super().__len__()-1] = (val, time.time())
-                self.__maybe_evict()
+                with self.__lock:
+                    super().append(val)
+                    self.__cache[super().__len__()-1] = (val, time.time())
+                    self.__maybe_evict()
 
             def extend(self, iterable):
                 saved = list(iterable)
-                startind = super().__len__()
-                super().extend(saved)
-                now = time.time()
-                self.__cache.update(((startind+i),(val,now)) for (i,val) in enumerate(saved))
-                self.__maybe_evict()
+                with self.__lock:
+                    startind = super().__len__()
+                    super().extend(saved)
+                    now = time.time()
+                    self.__cache.update(((startind+i),(val,now)) for (i,val) in enumerate(saved))
+                    self.__maybe_evict()
 
             def insert(self, ind, val):
-                super().insert(ind, val)
-                torem = [key for key in self.__cache if key >= ind]
-                for key in torem:
-                    del self.__cache[key]
-                self.__cache[key] = (val, time.time())
-                self.__maybe_evict()
+                with self.__lock:
+                    super().insert(ind, val)
+                    torem = [key for key in self.__cache if key >= ind]
+                    for key in torem:
+                        del self.__cache[key]
+                    self.__cache[key] = (val, time.time())
+                    self.__maybe_evict()
 
             def remove(self, val):
                 ind = super().index(val)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+class MemBackend:
+    """Stand-in for Backend that keeps every block in memory and does no
+    encryption, for tests and benchmarks."""
+
+    def __init__(self):
+        self.blocks = {}
+        self.length = 0
+
+    def __getitem__(self, index):
+        try:
+            return self.blocks[index]
+        except KeyError:
+            raise IndexError("index not stored in backend")
+
+    def __setitem__(self, index, data):
+        if index < 0:
+            raise IndexError("index out of bounds for backend")
+        self.blocks[index] = bytes(data)
+        self.length = max(self.length, index+1)
+
+    def append(self, newdata):
+        self[self.length] = newdata
+
+    def extend(self, newdata):
+        for data in newdata:
+            self.append(data)
+
+    def encrypt(self, plaintext):
+        return plaintext
+
+    def decrypt(self, ciphertext):
+        return ciphertext
+
+    def __len__(self):
+        return self.length
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+
+def percentile(ordered, frac):
+    """The given fraction (0 to 1) percentile of a sorted list."""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered)-1, int(frac * len(ordered)))]
+
+class RollingHistogram:
+    """Distribution of the most recent samples of one measurement."""
+
+    def __init__(self, window=1000):
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0 # total samples ever added
+        self.total = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        """Returns a dict describing the samples in the window."""
+        ordered = sorted(self.samples)
+        res = dict(count=self.count, window=len(ordered))
+        if ordered:
+            res.update(mean=sum(ordered)/len(ordered), min=ordered[0],
+                    p50=percentile(ordered, .5), p90=percentile(ordered, .9),
+                    p99=percentile(ordered, .99), max=ordered[-1])
+        return res
+
+class Metrics:
+    """A set of named RollingHistograms, created as they are first used."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.hists = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, value):
+        with self.lock:
+            try:
+                hist = self.hists[name]
+            except KeyError:
+                hist = self.hists[name] = RollingHistogram(self.window)
+            hist.add(value)
+
+    def record(self, values):
+        """Adds one sample for each name -> value in the given dict."""
+        for name, value in values.items():
+            self.add(name, value)
+
+    def summary(self):
+        """Returns a dict mapping each name to its histogram summary."""
+        with self.lock:
+            return {name: hist.summary() for (name, hist) in self.hists.items()}
+
+class Histogram:
+    """Cheap, fixed-size histogram with power-of-two buckets.
+    Bucket i counts samples between 2**(i-1) and 2**i units."""
+
+    def __init__(self, unit=1e-6, nbuckets=48):
+        self.unit = unit
+        self.buckets = [0] * nbuckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        ind = int(value / self.unit).bit_length()
+        self.buckets[min(ind, len(self.buckets)-1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, frac):
+        """Upper bound on the given fraction (0 to 1) percentile."""
+        want = frac * self.count
+        seen = 0
+        for ind, num in enumerate(self.buckets):
+            seen += num
+            if num and seen >= want:
+                return min(self.max, self.unit * 2**ind)
+        return self.max
+
+    def summary(self):
+        res = dict(count=self.count)
+        if self.count:
+            res.update(mean=self.total/self.count, p50=self.quantile(.5),
+                    p90=self.quantile(.9), p99=self.quantile(.99), max=self.max)
+        return res
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import threading
+
+from time import time
+
+# operations whose result is a file handle used by later operations
+HANDLE_OPS = ("open", "create", "opendir")
+
+# operations that aren't part of the workload
+SKIP_OPS = ("init", "destroy")
+
+class Payload(int):
+    """The length of a bytes argument whose contents were not recorded."""
+
+def _strip(arg):
+    if isinstance(arg, (bytes, bytearray)):
+        return Payload(len(arg))
+    return arg
+
+def _encode(arg):
+    """arg as JSON: a Payload becomes {"payload": length}, a tuple a list."""
+    if type(arg) is Payload:
+        return {"payload": int(arg)}
+    if isinstance(arg, (tuple, list)):
+        return [_encode(a) for a in arg]
+    return arg
+
+def _decode(arg):
+    if isinstance(arg, dict) and "payload" in arg:
+        return Payload(arg["payload"])
+    if isinstance(arg, list):
+        return tuple(_decode(a) for a in arg)
+    return arg
+
+class TraceRecorder:
+    """Writes a compact, gzipped trace of FUSE operations. Each record is a
+    line of JSON holding (seconds since start, op, path, args, result,
+    failed), where bytes arguments are replaced by their Payload length and
+    result is only kept for operations that return a file handle. Being
+    plain data, a trace is safe to read from anyone."""
+
+    def __init__(self, filename, flush_every=1000):
+        self.out = gzip.open(filename, "wt")
+        self.start = time()
+        self.lock = threading.Lock()
+        self.flush_every = flush_every
+        self.pending = 0
+
+    def record(self, when, op, path, args, ret, failed):
+        if op in SKIP_OPS:
+            return
+        rec = (when - self.start, op, path, tuple(_strip(a) for a in args),
+                ret if op in HANDLE_OPS else None, failed)
+        with self.lock:
+            if self.out is None:
+                return
+            self.out.write(json.dumps(_encode(rec), default=str) + "\n")
+            self.pending += 1
+            if self.pending >= self.flush_every:
+                self.out.flush()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            if self.out is not None:
+                self.out.close()
+                self.out = None
+
+def read_trace(filename):
+    """Yields the records of a trace file, in order. A trace that was cut
+    off (e.g. by a crash) ends at its last complete record."""
+    with gzip.open(filename, "rt") as f:
+        while True:
+            try:
+                line = f.readline()
+                rec = json.loads(line)
+            except (EOFError, OSError, ValueError):
+                return
+            yield _decode(rec)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import collections
+
+from vtable import VTable
+
+class Policy:
+    """Decides the order in which WoOram.sync tries to pack buffered
+    fragments. It only reorders: each round still writes the same K
+    blocks, and whatever doesn't fit waits for the next round.
+
+    order(avail, room, rnd) is given the buffered (vnode, boff, size)
+    tuples in FIFO order, the number of bytes free in the blocks being
+    written, and the number of the round, and returns them reordered.
+    Afterwards, last holds any measurements of its own for the round.
+
+    is_meta(vnode) says whether a vnode holds metadata (directories);
+    by default only the root directory does.
+    """
+
+    def __init__(self):
+        self.last = {}
+        self.is_meta = lambda vnode: vnode == VTable._ROOT_VNODE
+
+    def note_set(self, vnode, boff, rnd):
+        """Called whenever a fragment is buffered."""
+        pass
+
+    def order(self, avail, room, rnd):
+        return avail
+
+class Fifo(Policy):
+    """Oldest fragment first, whatever it belongs to."""
+    pass
+
+class FinishFile(Policy):
+    """All the fragments of the file with the oldest one, then all those
+    of the file with the next oldest, and so on, so that files become
+    visible to other clients one at a time rather than all at the end."""
+
+    def order(self, avail, room, rnd):
+        byfile = collections.OrderedDict()
+        for item in avail:
+            byfile.setdefault(item[0], []).append(item)
+        return [item for items in byfile.values() for item in items]
+
+class MetadataFirst(Policy):
+    """Directories before everything else, so that new names show up
+    (and later point at data) as soon as possible."""
+
+    def order(self, avail, room, rnd):
+        meta = [item for item in avail if self.is_meta(item[0])]
+        self.last = dict(frags_meta=len(meta))
+        if not meta:
+            return avail
+        return meta + [item for item in avail if not self.is_meta(item[0])]
+
+class DeferHot(Policy):
+    """Holds back fragments that were rewritten within the last hold
+    rounds, since they are likely to be rewritten again before long,
+    but never for more than max_hold rounds. Held back fragments are
+    tried last rather than not at all."""
+
+    def __init__(self, hold=2, max_hold=20):
+        super().__init__()
+        self.hold = hold
+        self.max_hold = max_hold
+        self.sets = {} # (vnode, boff) -> [first round buffered, last round set, times set]
+
+    def note_set(self, vnode, boff, rnd):
+        info = self.sets.get((vnode, boff))
+        if info is None:
+            self.sets[vnode, boff] = [rnd, rnd, 1]
+        else:
+            info[1] = rnd
+            info[2] += 1
+
+    def order(self, avail, room, rnd):
+        # forget what has left the buffer
+        keys = {(vnode, boff) for (vnode, boff, size) in avail}
+        for key in [key for key in self.sets if key not in keys]:
+            del self.sets[key]
+        cold, hot = [], []
+        for item in avail:
+            first, last, times = self.sets.get(item[:2], (rnd, rnd, 1))
+            if times > 1 and rnd - last < self.hold and rnd - first < self.max_hold:
+                hot.append(item)
+            else:
+                cold.append(item)
+        self.last = dict(frags_deferred=len(hot))
+        return cold + hot
+
+class SizeAware(Policy):
+    """Takes the oldest fragments that could fill the room available
+    twice over and tries them largest first, so that full fragments get
+    whole halves and small ones fill in the gaps; the rest stay in FIFO
+    order."""
+
+    def order(self, avail, room, rnd):
+        total = 0
+        for n, (vnode, boff, size) in enumerate(avail):
+            total += size
+            if total > 2*room:
+                break
+        else:
+            n = len(avail)
+        head = sorted(avail[:n+1], key=lambda item: -item[2])
+        return head + avail[n+1:]
+
+POLICIES = collections.OrderedDict([
+    ("fifo", Fifo),
+    ("finish_file", FinishFile),
+    ("metadata_first", MetadataFirst),
+    ("defer_hot", DeferHot),
+    ("size_aware", SizeAware),
+])
+
+def make_policy(name):
+    """The policy with the given name in POLICIES."""
+    try:
+        return POLICIES[name]()
+    except KeyError:
+        raise ValueError("unknown flush policy: {} (choose from {})".format(
+            name, ", ".join(POLICIES)))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import sys
+import queue
+import threading
+
+DEBUG=False
+
+class _Stream:
+    __slots__ = ("buf", "vnode", "next", "window", "ahead", "behind")
+
+    def __init__(self, buf, vnode):
+        self.buf = buf # the FileBuffer being read
+        self.vnode = vnode
+        self.next = 0 # where a sequential read would start
+        self.window = 0 # fragments to keep fetched ahead of the reader
+        self.ahead = 0 # fragments before this have been asked for
+        self.behind = 0 # fragments before this have been dropped
+
+class Readahead:
+    """Fetches fragments of files that are being read sequentially before
+    they are needed, on a background thread.
+
+    Each handle is watched separately. While every read starts where the
+    previous one ended, the window of fragments fetched ahead of the
+    reader doubles, up to max_window; any other read resets it. Fragments
+    a sequential reader has moved past are dropped from its FileBuffer,
+    so each stream holds about max_window fragments at most.
+
+    fetch(keys) is given a list of (vnode, boff) pairs and returns their
+    fragments in order (None for any that are unavailable), as
+    RoOram.get_many does, fetching each backend block only once.
+    """
+
+    def __init__(self, fetch, max_window=8):
+        self.fetch = fetch
+        self.max_window = max_window
+        self.streams = {} # fh -> _Stream
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue() # (stream, [boff, ...])
+        self.worker = None
+        self.fetched = 0 # fragments fetched ahead
+        self.used = 0 # of those, how many were installed
+
+    def after_read(self, fh, buf, vnode, offset, size):
+        """Notes a read of size bytes at offset through handle fh,
+        and queues whatever should now be fetched ahead."""
+        if self.max_window <= 0:
+            return
+        fbsize = buf.fbsize
+        with self.lock:
+            st = self.streams.get(fh)
+            if st is None or st.buf is not buf:
+                st = self.streams[fh] = _Stream(buf, vnode)
+            if offset == st.next and size > 0:
+                st.window = min(max(1, 2*st.window), self.max_window)
+            else:
+                st.window = 0
+                st.ahead = st.behind = offset // fbsize
+            st.next = offset + size
+            cur = max(st.next - 1, 0) // fbsize
+            last = min(cur + st.window, -(-len(buf) // fbsize) - 1)
+            wanted = list(range(max(st.ahead, cur + 1), last + 1))
+            st.ahead = max(st.ahead, last + 1)
+            behind = range(st.behind, cur) if st.window else range(0)
+            st.behind = max(st.behind, cur)
+        if behind:
+            with buf.lock:
+                for boff in behind:
+                    if boff < len(buf.frags) and boff not in buf.dirty:
+                        buf.evict(boff)
+        if wanted:
+            self._start()
+            self.jobs.put((st, wanted))
+
+    def forget(self, fh):
+        """Stops watching a handle that was released."""
+        with self.lock:
+            self.streams.pop(fh, None)
+
+    def _start(self):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+
+    def _run(self):
+        while True:
+            st, boffs = self.jobs.get()
+            buf = st.buf
+            boffs = [b for b in boffs if b < len(buf.frags) and buf.frags[b] is None]
+            if not boffs:
+                continue
+            try:
+                frags = self.fetch([(st.vnode, b) for b in boffs])
+            except (KeyError, IndexError):
+                continue # changed meanwhile; the reader finds out itself
+            with buf.lock:
+                used = sum(buf.fill(b, data) for b, data in zip(boffs, frags))
+            self.fetched += len(boffs)
+            self.used += used
+            if DEBUG: print("readahead: vnode {} fragments {}..{}: used {}".format(
+                st.vnode, boffs[0], boffs[-1], used), file=sys.stderr)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import struct
+import getopt
+import tempfile
+import contextlib
+
+from fuse import FuseOSError
+from membackend import MemBackend
+from optrace import Payload, HANDLE_OPS, read_trace
+from fusebench import Harness
+import ObliviSync
+
+USAGE = """{} [OPTIONS] <trace>
+Replays a trace recorded with ObliviSync.py -R against a fresh volume,
+through the FUSE operations but without a kernel mount, and prints a JSON
+report of operation latencies.
+
+OPTIONS
+    -h      \t: print this help screen
+    -a      \t: as fast as possible, instead of at the original timing
+    -b num  \t: backend block size (dflt: 4194304)
+    -n num  \t: backend total blocks (dflt: 1024)
+    -t num  \t: drip time; 0 means no sync thread (dflt: 0)
+    -r dir  \t: use a real (encrypted) Backend in a fresh subdirectory of dir
+    -o file \t: append the report to file (dflt: stdout)
+""".format(sys.argv[0])
+
+# position of the file handle among the arguments (after the path)
+FH_ARG = dict(read=2, write=2, release=0, flush=0, fsync=1, truncate=1,
+        readdir=0, releasedir=0, fsyncdir=1, getattr=0)
+
+class Filler:
+    """Makes stand-in contents for recorded payloads. Every payload is
+    different, so none of them look like holes or duplicates."""
+    def __init__(self, size=2**20):
+        self.pool = os.urandom(size)
+        self.count = 0
+
+    def make(self, length):
+        self.count += 1
+        stamp = struct.pack(">Q", self.count)
+        res = bytearray()
+        while len(res) < length:
+            res += stamp + self.pool[:length - len(res) - len(stamp)]
+        return bytes(res[:length])
+
+def replay(fs, records, realtime=True):
+    """Re-executes trace records against the Operations object fs.
+    Returns the Harness holding the timings, the number of operations
+    whose success or failure differed from the trace, and the number of
+    operations that were skipped because they used an unknown handle."""
+    call = Harness(fs)
+    filler = Filler()
+    handles = {} # recorded fh -> replayed fh
+    mismatches = skipped = 0
+    start = time.time()
+    for (when, op, path, args, ret, failed) in records:
+        if realtime:
+            delay = start + when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        args = list(args)
+        for i, arg in enumerate(args):
+            if type(arg) is Payload:
+                args[i] = filler.make(arg)
+        pos = FH_ARG.get(op)
+        if pos is not None and pos < len(args) and args[pos] is not None:
+            if args[pos] in handles:
+                args[pos] = handles[args[pos]]
+            elif op not in ("getattr", "truncate", "readdir", "releasedir"):
+                # opened before the recording started
+                skipped += 1
+                continue
+        try:
+            res = call(op, path, *args)
+            if op in HANDLE_OPS and ret is not None:
+                handles[ret] = res
+            ok = True
+        except (FuseOSError, OSError, KeyError):
+            ok = False
+        if ok == failed:
+            mismatches += 1
+    return call, mismatches, skipped
+
+if __name__ == '__main__':
+    realtime = True
+    blocksize = 2**22
+    N = 2**10
+    drip_time = 0
+    realdir = None
+    out = sys.stdout
+
+    opt, args = getopt.getopt(sys.argv[1:], "hab:n:t:r:o:")
+    for o, v in opt:
+        if o == "-h":
+            print(USAGE)
+            exit(0)
+        if o == "-a":
+            realtime = False
+        if o == "-b":
+            blocksize = int(v, 0)
+        if o == "-n":
+            N = int(v, 0)
+        if o == "-t":
+            drip_time = int(v)
+        if o == "-r":
+            realdir = v
+        if o == "-o":
+            out = open(v, "a")
+    if len(args) != 1:
+        print(USAGE)
+        exit(1)
+
+    if realdir is None:
+        back = MemBackend()
+    else:
+        from backend import Backend
+        back = Backend(bytes(16), tempfile.mkdtemp(dir=realdir))
+    with contextlib.redirect_stdout(sys.stderr):
+        fs = ObliviSync.ObliviSyncRW(backend=back, blocksize=blocksize,
+                total_blocks=N, drip_time=drip_time)
+
+    start = time.perf_counter()
+    call, mismatches, skipped = replay(fs, read_trace(args[0]), realtime)
+    elapsed = time.perf_counter() - start
+    ops = sum(len(t) for t in call.lat.values())
+    res = dict(trace=args[0], realtime=realtime, blocksize=blocksize, N=N,
+            drip_time=drip_time, seconds=elapsed, ops=ops, bytes=call.nbytes,
+            ops_per_s=ops/elapsed if elapsed else None,
+            mismatches=mismatches, skipped=skipped, latency=call.report(),
+            buffered_bytes=fs.woo.buf.size())
+    print(json.dumps(res, sort_keys=True), file=out)
+    with contextlib.redirect_stdout(sys.stderr):
+        fs.woo.finish()
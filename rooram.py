@@ -7,12 +7,16 @@ import time
 import math
 import threading
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 from block import Block
 from vtable import VTable
-from superblock import load_superblock
+from superblock import load_superblock, peek_generation
 from rwlock import get_rw_locks
 
 DEBUG=False
+FETCH_THREADS=4 # backend blocks read (and decrypted) at once
 
 def load_rooram(backend):
     """Attempts to load a wooram object from the given backend.
@@ -33,12 +37,21 @@ class RoOram:
         self.fbsize = sup.fbsize
         self.split_maxnum = sup.split_maxnum
         self.split_maxsize = sup.split_maxsize
+        self.slots = sup.slots # fragments per backend block
+        self.generation = sup.generation
+        self.fetchers = ThreadPoolExecutor(FETCH_THREADS)
 
     def supdate(self):
-        """Updates vtable from superblock, if necessary."""
-        # TODO check if it's actually been changed before re-reading
+        """Updates vtable from superblock, if necessary: it is only
+        re-read when the generation in its header has changed (or when
+        the superblock has no generation, from an older version)."""
+        gen = peek_generation(self.backend)
+        if gen is not None and gen == self.generation:
+            return
         with self.wlock:
-            self.vtable = load_superblock(self.backend).vtable
+            sup = load_superblock(self.backend)
+            self.vtable = sup.vtable
+            self.generation = sup.generation
 
     def start(self):
         pass
@@ -113,33 +126,73 @@ class RoOram:
                     res = None
                     break
                 res.append(Block(self, kind, contents))
-        if res is None or len(res) != 2:
-            return tuple(Block(self, Block.EMPTY) for _ in range(2))
+        if res is None or len(res) != self.slots:
+            return tuple(Block(self, Block.EMPTY) for _ in range(self.slots))
         else:
             return tuple(res)
 
+    def _get_backends(self, inds):
+        """Like _get_backend for each of a list of indices, reading them
+        in parallel."""
+        if len(inds) <= 1:
+            return [self._get_backend(ind) for ind in inds]
+        return list(self.fetchers.map(self._get_backend, inds))
+
     def _fetch_block_inode(self, vnode, inode, split):
         """Gets the contents of the given vnode stored in backend at the given
         inode. split is a bool indicating whether it's an sblock."""
-        assert 0 <= inode < 2*self.N
-        parts = self._get_backend(inode//2)
+        assert 0 <= inode < self.slots*self.N
+        return self._from_parts(self._get_backend(inode//self.slots), vnode, inode, split)
+
+    def _from_parts(self, parts, vnode, inode, split):
+        """Picks the contents of the given vnode out of the Blocks
+        stored at inode//self.slots."""
         if split:
             for blk in parts:
                 if blk.kind() == Block.SPLIT and vnode in blk.contents:
                     return blk.contents[vnode]
         else:
-            blk = parts[inode % 2]
+            blk = parts[inode % self.slots]
             if blk.kind() == Block.FULL and blk.contents[0] == vnode:
                 return blk.contents[1]
         return None
 
-    def get(self, vnode, boff):
+    def get(self, vnode, boff, update=True):
+        """Returns the given fragment, or None if it's inaccessible.
+        With update=False, uses the vtable as already loaded, so that
+        several fragments can be read against one consistent snapshot."""
         res = None
-        self.supdate()
+        if update: self.supdate()
         with self.rlock:
             inode, split = self.vtable.get_inodes(vnode)[boff]
-            if inode >= 0:
-                res = self._fetch_block_inode(vnode, inode, split)
+            if inode == VTable._HOLE:
+                res = bytes(self.vtable.block_size(vnode, boff))
+            elif inode >= 0:
+                owner = self.vtable.owner(vnode, boff, inode)
+                res = self._fetch_block_inode(owner, inode, split)
         if DEBUG: print("rooram: get: buf[{}:{}]=>len({})".format(vnode,boff,len(res) if res else None), file=sys.stderr)
         return res
 
+
+    def get_many(self, keys, update=True):
+        """Returns the fragments for a list of (vnode, boff) pairs, in the
+        same order, resolved against one vtable snapshot. Each backend
+        block holding any of them is fetched once, several in parallel.
+        As with get, each is None if it's inaccessible."""
+        if update: self.supdate()
+        res = [None] * len(keys)
+        with self.rlock:
+            wanted = defaultdict(list) # backend index -> [(i, vnode, inode, split)]
+            for i, (vnode, boff) in enumerate(keys):
+                inode, split = self.vtable.get_inodes(vnode)[boff]
+                if inode == VTable._HOLE:
+                    res[i] = bytes(self.vtable.block_size(vnode, boff))
+                elif inode >= 0:
+                    owner = self.vtable.owner(vnode, boff, inode)
+                    wanted[inode//self.slots].append((i, owner, inode, split))
+            inds = sorted(wanted)
+            for ind, parts in zip(inds, self._get_backends(inds)):
+                for i, vnode, inode, split in wanted[ind]:
+                    res[i] = self._from_parts(parts, vnode, inode, split)
+        if DEBUG: print("rooram: get_many: {} fragments from {} blocks".format(len(keys),len(wanted)), file=sys.stderr)
+        return res
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import pickle
+import struct
+import threading
+
+_LEN = struct.Struct(">I")
+
+class SegmentLog:
+    """An append-only sequence of encrypted records, stored locally in
+    numbered segment files. Each record can be read back from the
+    (segno, offset) location returned when it was appended.
+
+    crypt can be any object with encrypt(bytes) and decrypt(bytes) methods,
+    such as a Backend or a Cipher.
+    """
+
+    def __init__(self, directory, crypt, prefix="seg", segsize=2**26):
+        self.directory = directory
+        self.crypt = crypt
+        self.prefix = prefix
+        self.segsize = segsize
+        self.lock = threading.RLock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.segnos = sorted(self._existing())
+        self.fds = {} # segno -> fd opened for reading
+        self.wfd = None # fd of the segment currently being appended to
+        self.wno = None
+        self.woff = 0
+
+    def _existing(self):
+        pre = self.prefix + "."
+        for name in os.listdir(self.directory):
+            if name.startswith(pre):
+                try:
+                    yield int(name[len(pre):])
+                except ValueError:
+                    # ignore extraneous files
+                    continue
+
+    def _name(self, segno):
+        return os.path.join(self.directory, "{}.{}".format(self.prefix, segno))
+
+    def _rfd(self, segno):
+        try:
+            return self.fds[segno]
+        except KeyError:
+            fd = os.open(self._name(segno), os.O_RDONLY)
+            self.fds[segno] = fd
+            return fd
+
+    def current(self):
+        """The segment number that new records are appended to, or None."""
+        return self.wno
+
+    def append(self, obj):
+        """Encrypts and stores obj at the end of the log.
+        Returns its (segno, offset) location."""
+        rec = self.crypt.encrypt(pickle.dumps(obj))
+        with self.lock:
+            if self.wfd is None or self.woff >= self.segsize:
+                self._rotate()
+            loc = (self.wno, self.woff)
+            os.write(self.wfd, _LEN.pack(len(rec)) + rec)
+            self.woff += _LEN.size + len(rec)
+        return loc
+
+    def _rotate(self):
+        if self.wfd is not None:
+            os.close(self.wfd)
+        self.wno = self.segnos[-1] + 1 if self.segnos else 0
+        self.segnos.append(self.wno)
+        self.wfd = os.open(self._name(self.wno),
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.woff = 0
+
+    def read(self, loc):
+        """Returns the record stored at the given (segno, offset) location."""
+        segno, off = loc
+        with self.lock:
+            fd = self._rfd(segno)
+            head = os.pread(fd, _LEN.size, off)
+            rec = os.pread(fd, _LEN.unpack(head)[0], off + _LEN.size)
+        return pickle.loads(self.crypt.decrypt(rec))
+
+    def records(self):
+        """Yields (location, record) pairs for everything in the log,
+        oldest first. A torn or corrupted record ends its segment."""
+        for segno in list(self.segnos):
+            with open(self._name(segno), "rb") as f:
+                off = 0
+                while True:
+                    head = f.read(_LEN.size)
+                    if len(head) < _LEN.size:
+                        break
+                    rec = f.read(_LEN.unpack(head)[0])
+                    try:
+                        obj = pickle.loads(self.crypt.decrypt(rec))
+                    except Exception:
+                        print("WARNING: corrupted record in segment", segno,
+                                "at offset", off, file=sys.stderr)
+                        break
+                    yield (segno, off), obj
+                    off += _LEN.size + len(rec)
+
+    def sync(self):
+        """Forces everything appended so far out to disk."""
+        with self.lock:
+            if self.wfd is not None:
+                os.fsync(self.wfd)
+
+    def remove(self, segno):
+        """Deletes a whole segment. Any records in it become unreadable."""
+        with self.lock:
+            if segno == self.wno:
+                os.close(self.wfd)
+                self.wfd = self.wno = None
+            try:
+                os.close(self.fds.pop(segno))
+            except KeyError:
+                pass
+            self.segnos.remove(segno)
+            os.remove(self._name(segno))
+
+    def clear(self):
+        """Deletes every segment."""
+        with self.lock:
+            for segno in list(self.segnos):
+                self.remove(segno)
+
+    def close(self):
+        with self.lock:
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
+            if self.wfd is not None:
+                os.close(self.wfd)
+                self.wfd = self.wno = None
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import math
+import time
+import heapq
+import random
+import getopt
+import collections
+
+from block import Block
+from superblock import new_superblock, calc_sizes
+from wooram import WoOram
+from policy import make_policy
+
+USAGE = """{} [OPTIONS] <workload.json>
+Simulates how a WoOram drains a workload, using the real sync, packing
+and vtable code with a virtual clock and no actual data or encryption.
+
+OPTIONS
+    -h      \t: print this help screen
+    -s num  \t: random seed (dflt: 1985)
+    -o file \t: write the JSON report to file (dflt: stdout)
+
+The workload file is a JSON object such as
+{{
+  "blocksize": 4194304, "N": 1024, "slots": 2, "K": 3, "T": 3,
+  "policy": "fifo", "repack": false,
+  "max_time": 86400,
+  "sample_every": 100,
+  "disk": {{"read_mbps": 100, "write_mbps": 50, "crypto_mbps": 200, "jitter": 0.2}},
+  "streams": [
+    {{"count": 1, "at": 0, "size": {{"dist": "fixed", "value": 2e8}}}},
+    {{"rate": 0.05, "start": 0, "stop": 7200,
+      "size": {{"dist": "lognormal", "median": 50000, "sigma": 2}},
+      "lifetime": {{"dist": "exponential", "mean": 3600}}}}
+  ]
+}}
+Each stream either writes count files at time "at", or writes files as a
+Poisson process with the given rate (per second) between start and stop.
+Files with a lifetime are deleted that long after being written.
+Each backend block holds slots full fragments (or split ones together).
+The policy is the order in which buffered fragments are synced (see policy.py);
+repack enables WoOram's repacking of small fragments.
+Size distributions: fixed (value), uniform (min, max), lognormal (median,
+sigma), exponential (mean) and choice (values, optional weights).
+""".format(sys.argv[0])
+
+class Ghost:
+    """Stands in for a fragment of the given length without storing it."""
+    __slots__ = ("length",)
+
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+class SimOram(WoOram):
+    """A WoOram whose backend holds block contents directly, with no
+    pickling, padding or superblock."""
+
+    def _make_block(self, blist):
+        return tuple(b.contents for b in blist)
+
+    def _get_backend(self, ind):
+        try:
+            parts = self.backend[ind]
+        except KeyError:
+            return tuple(Block(self, Block.EMPTY) for _ in range(self.slots))
+        res = []
+        for contents in parts:
+            if contents is None:
+                res.append(Block(self, Block.EMPTY))
+            elif type(contents) is dict:
+                res.append(Block(self, Block.SPLIT, dict(contents)))
+            else:
+                res.append(Block(self, Block.FULL, contents))
+        return tuple(res)
+
+    def _save_superblock(self):
+        pass
+
+def draw(dist, rand):
+    """Draws one value from a size or time distribution description."""
+    kind = dist["dist"]
+    if kind == "fixed":
+        return dist["value"]
+    elif kind == "uniform":
+        return rand.uniform(dist["min"], dist["max"])
+    elif kind == "lognormal":
+        return dist["median"] * math.exp(rand.gauss(0, dist["sigma"]))
+    elif kind == "exponential":
+        return rand.expovariate(1 / dist["mean"])
+    elif kind == "choice":
+        return rand.choices(dist["values"], dist.get("weights"))[0]
+    else:
+        raise ValueError("unknown distribution: " + kind)
+
+def events(workload, rand):
+    """Yields (time, kind, size or index) workload events in time order,
+    where kind is 'write' or 'delete'."""
+    pending = []
+    for stream in workload["streams"]:
+        if "count" in stream:
+            times = [stream.get("at", 0)] * stream["count"]
+        else:
+            times = []
+            when = stream.get("start", 0) + rand.expovariate(stream["rate"])
+            while when < stream.get("stop", workload.get("max_time", 86400)):
+                times.append(when)
+                when += rand.expovariate(stream["rate"])
+        for when in times:
+            size = max(1, int(draw(stream["size"], rand)))
+            life = draw(stream["lifetime"], rand) if "lifetime" in stream else None
+            pending.append((when, size, life))
+    pending.sort(key=lambda x: x[0])
+    # lifetimes are turned into delete events as we go
+    deletes = []
+    for index, (when, size, life) in enumerate(pending):
+        while deletes and deletes[0][0] <= when:
+            yield heapq.heappop(deletes)
+        yield (when, "write", (index, size))
+        if life is not None:
+            heapq.heappush(deletes, (when + life, "delete", index))
+    while deletes:
+        yield heapq.heappop(deletes)
+
+def round_time(woo, disk, rand):
+    """Modeled wall-clock seconds for one sync round on the given disk."""
+    mb = woo.K * woo.blocksize / 2**20
+    secs = (mb / disk.get("read_mbps", 100) + mb / disk.get("write_mbps", 100)
+            + 2 * mb / disk.get("crypto_mbps", 200) + disk.get("overhead", 0.05))
+    jitter = disk.get("jitter", 0)
+    if jitter:
+        secs *= math.exp(rand.gauss(0, jitter))
+    return secs
+
+def occupancy(woo):
+    """How the backend's slots are used, ignoring anything stale: how many
+    are empty, hold a full fragment or hold split fragments, the bytes
+    stored in them, and the fraction of the non-empty ones that is used."""
+    kinds = collections.Counter()
+    stored = 0
+    for ind in range(1, woo.N):
+        for b in woo._get_fresh(ind):
+            kinds[b.kind()] += 1
+            stored += b.size()
+    used = kinds[Block.FULL] + kinds[Block.SPLIT]
+    return dict(slots_empty=kinds[Block.EMPTY], slots_full=kinds[Block.FULL],
+            slots_split=kinds[Block.SPLIT], stored_bytes=stored,
+            packing=stored / (used * woo.fbsize) if used else None)
+
+def simulate(workload, seed=1985):
+    """Runs the simulation described by the workload dict and returns
+    a report dict."""
+    rand = random.Random(seed)
+    random.seed(seed) # for the eviction choices in sync
+    T = workload.get("T", 3)
+    sup = new_superblock(workload.get("blocksize", 2**22), workload.get("N", 2**10),
+            workload.get("headerlen", 48), workload.get("slots", 2))
+    woo = SimOram({}, sup, workload.get("K", 3), T,
+            policy=make_policy(workload.get("policy", "fifo")),
+            repack=workload.get("repack", False))
+    fb = woo.fbsize
+    disk = workload.get("disk", {})
+    max_time = workload.get("max_time", 86400)
+    sample_every = workload.get("sample_every", 100)
+
+    evs = events(workload, rand)
+    nextev = next(evs, None)
+    vnodes = {}
+    rounds = overruns = 0
+    written = 0
+    last_write = 0
+    peak_buf = 0
+    samples = []
+    rtimes = []
+    started = time.perf_counter()
+    now = 0
+    while now <= max_time:
+        # apply everything that happened before this round
+        while nextev is not None and nextev[0] <= now:
+            when, kind, arg = nextev
+            if kind == "write":
+                index, size = arg
+                vnode = woo.new()
+                for boff in range((size + fb - 1) // fb):
+                    woo.set(vnode, boff, Ghost(min(fb, size - boff*fb)))
+                vnodes[index] = vnode
+                written += size
+                last_write = when
+            elif arg in vnodes:
+                woo.delete(vnodes.pop(arg))
+            nextev = next(evs, None)
+        if nextev is None and not woo.buf and not woo.vtable.has_shadow():
+            break
+
+        woo.sync()
+        rounds += 1
+        secs = round_time(woo, disk, rand)
+        rtimes.append(secs)
+        if secs > T:
+            overruns += 1
+        peak_buf = max(peak_buf, woo.buf.size())
+        if rounds % sample_every == 0:
+            samples.append(dict(time=now, buffer_bytes=woo.buf.size(),
+                buffer_frags=len(woo.buf), utilization=woo.size()/woo.capacity()))
+        now += T
+
+    rtimes.sort()
+    drained = not woo.buf
+    return dict(
+            rounds=rounds,
+            simulated_seconds=now,
+            wall_seconds=time.perf_counter() - started,
+            bytes_written=written,
+            last_write=last_write,
+            drained=drained,
+            drain_time=now - last_write if drained else None,
+            peak_buffer_bytes=peak_buf,
+            final_buffer_bytes=woo.buf.size(),
+            utilization=woo.size()/woo.capacity(),
+            occupancy=occupancy(woo),
+            overrun_rounds=overruns,
+            overrun_risk=overruns/rounds if rounds else 0,
+            round_time_p50=rtimes[len(rtimes)//2] if rtimes else None,
+            round_time_max=rtimes[-1] if rtimes else None,
+            sync=woo.sync_stats(),
+            samples=samples)
+
+if __name__ == '__main__':
+    seed = 1985
+    out = sys.stdout
+    opt, args = getopt.getopt(sys.argv[1:], "hs:o:")
+    for o, v in opt:
+        if o == "-h":
+            print(USAGE)
+            exit(0)
+        if o == "-s":
+            seed = int(v)
+        if o == "-o":
+            out = open(v, "w")
+    if len(args) != 1:
+        print(USAGE)
+        exit(1)
+    with open(args[0]) as f:
+        workload = json.load(f)
+    try:
+        calc_sizes(workload.get("blocksize", 2**22), workload.get("headerlen", 48),
+                workload.get("slots", 2))
+    except ValueError as e:
+        print("ERROR:", e, file=sys.stderr)
+        print(USAGE)
+        exit(1)
+    json.dump(simulate(workload, seed), out, indent=1, sort_keys=True)
+    print(file=out)
@@ -2,35 +2,69 @@
 
 import collections
 import pickle
+import struct
 from vtable import create_vtable, load_vtable
 
-_VERSION = 3
+_VERSION = 6 # adds the number of slots per block
+
+# Since version 4, the superblock starts with this fixed header, so the
+# generation (bumped on every save) can be checked without unpickling.
+_MAGIC = b'OSsuper\0'
+_HEADER = struct.Struct(">8sQ") # magic, generation
 
 SuperBlock = collections.namedtuple("SuperBlock", 
-        ["vtable", "blocksize", "total_blocks", "headerlen", "fbsize", "split_maxnum", "split_maxsize"])
+        ["vtable", "blocksize", "total_blocks", "headerlen", "fbsize", "split_maxnum", "split_maxsize",
+         "generation", "slots"], defaults=(0, 2))
 
-def calc_sizes(blocksize, headerlen):
-    fbsize = (blocksize - headerlen - 200) // 2
+def calc_sizes(blocksize, headerlen, slots=2):
+    """Each backend block holds slots fragments of fbsize bytes, or split
+    fragments of up to sbsize bytes together (at most max_splits).
+    Raises ValueError if blocksize is too small for that many slots."""
+    if slots < 1:
+        raise ValueError("there must be at least 1 slot per block, not {}".format(slots))
     max_splits = 2**10
+    # the smallest block size leaving a positive sbsize
+    minsize = headerlen + slots*(100 + 10*max_splits + 1)
+    if blocksize < minsize:
+        raise ValueError("block size {} is too small for {} slots; it must be at least {}"
+                .format(blocksize, slots, minsize))
+    fbsize = (blocksize - headerlen - 100*slots) // slots
     sbsize = fbsize - 10*max_splits # TODO kind of hackish, possibly innacurate
     assert all(x>0 for x in (fbsize, max_splits, sbsize))
     return fbsize, max_splits, sbsize
 
-def new_superblock(bsize, N, headlen):
+def new_superblock(bsize, N, headlen, slots=2):
     global _VERSION
-    fbsize, max_splits, sbsize = calc_sizes(bsize, headlen)
-    return SuperBlock(create_vtable(fbsize, sbsize), 
-            bsize, N, headlen, fbsize, max_splits, sbsize)
+    fbsize, max_splits, sbsize = calc_sizes(bsize, headlen, slots)
+    return SuperBlock(create_vtable(fbsize, sbsize, slots), 
+            bsize, N, headlen, fbsize, max_splits, sbsize, 0, slots)
 
-def save_superblock(backend, vtable, bsize, N, headlen):
+def save_superblock(backend, vtable, bsize, N, headlen, generation=0, slots=2):
     global _VERSION
-    assert N >= 1 and bsize > headlen >= 0
-    data = pickle.dumps((vtable.save(), bsize, N, headlen, _VERSION))
+    assert N >= 1 and bsize > headlen >= 0 and slots >= 1
+    data = (_HEADER.pack(_MAGIC, generation)
+            + pickle.dumps((vtable.save(), bsize, N, headlen, _VERSION, slots)))
     if len(data) + headlen > bsize:
         raise ValueError("superblock is too big")
     data = data + b'\0'*(bsize-headlen-len(data))
     backend[0] = data
 
+def _read_generation(raw):
+    """The generation in the header of raw superblock data,
+    or None if it has none (version 3)."""
+    if raw[:len(_MAGIC)] == _MAGIC:
+        return _HEADER.unpack_from(raw)[1]
+    return None
+
+def peek_generation(backend):
+    """Returns the generation of the stored superblock without unpickling
+    it, or None if it can't be told. Reading the backend is cheap when the
+    block is cached and unchanged."""
+    try:
+        return _read_generation(backend[0])
+    except (IndexError, struct.error):
+        return None
+
 def load_superblock(backend):
     global _VERSION
     try:
@@ -38,12 +72,17 @@ def load_superblock(backend):
     except IndexError:
         raise ValueError("backend has no superblock file")
     try:
-        vtsave, bsize, N, headlen, vers = pickle.loads(raw)
-        fbsize, max_splits, sbsize = calc_sizes(bsize, headlen)
-        vtab = load_vtable(vtsave, fbsize, sbsize)
+        generation = _read_generation(raw)
+        if generation is not None:
+            raw = raw[_HEADER.size:]
+        vtsave, bsize, N, headlen, vers, *rest = pickle.loads(raw)
+        slots = rest[0] if rest else 2 # before version 6, always 2
+        fbsize, max_splits, sbsize = calc_sizes(bsize, headlen, slots)
+        vtab = load_vtable(vtsave, fbsize, sbsize, slots)
     except:
         raise ValueError("couldn't unpickle superblock")
-    if vers == _VERSION:
-        return SuperBlock(vtab, bsize, N, headlen, fbsize, max_splits, sbsize)
+    if vers in (4, 5, _VERSION) or (vers == 3 and generation is None):
+        return SuperBlock(vtab, bsize, N, headlen, fbsize, max_splits, sbsize,
+                generation or 0, slots)
     else:
         raise ValueError("superblock created from incompatible version")
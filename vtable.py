@@ -6,43 +6,58 @@ from rwlock import get_rw_locks
 
 # TODO there should be a btree setup as well...
 
-VTableData = collections.namedtuple("VTableData", ["next_free", "free", "cache"])
+VTableData = collections.namedtuple("VTableData", ["next_free", "free", "cache", "links"],
+        defaults=(None,))
 
 VTEntry = collections.namedtuple("VTEntry", ["mtime", "lbsize", "inodes"])
 
-def create_vtable(fbsize, sbmax):
-    res = VTable(fbsize, sbmax)
+def create_vtable(fbsize, sbmax, slots=2):
+    res = VTable(fbsize, sbmax, slots)
     res.next_free = VTable._ROOT_VNODE + 1
     res.free = set()
     res.cache = {VTable._ROOT_VNODE: VTEntry(time.time(), fbsize, [])}
+    res.links = {}
     return res
 
-def load_vtable(data, fbsize, sbmax):
+def load_vtable(data, fbsize, sbmax, slots=2):
     """data should be a VTableData object."""
-    res = VTable(fbsize, sbmax)
+    res = VTable(fbsize, sbmax, slots)
     res.next_free = data.next_free
     res.free = set(data.free)
     res.cache = data.cache
+    res.links = data.links or {}
+    res.prune_links()
     return res
 
 class VTable:
-    """Stores vnode->[inode list] mappings, as well as size and mtime."""
+    """Stores vnode->[inode list] mappings, as well as size and mtime.
+    Inode slots*i + j is slot j of backend block i; a split fragment may
+    be in any slot of the block its inode is in.
+
+    A full fragment may also be a reference to one already stored for
+    another vnode (see link). links maps (vnode, boff, inode) to the vnode
+    the fragment is stored under in the backend, and targets counts the
+    references to each (owner, inode), so that it isn't stale while any
+    vnode still refers to it."""
     _ROOT_VNODE = 1
     """Special inode values"""
     _STALE = -2
+    _HOLE = -3 # all null bytes, so not stored anywhere
 
-    def __init__(self, fbsize, sbmax):
+    def __init__(self, fbsize, sbmax, slots=2):
         self.shadow = {}
         self.rlock, self.wlock = get_rw_locks()
         self.fbsize = fbsize
         self.sbmax = sbmax
+        self.slots = slots
+        self.targets = collections.Counter()
 
     def save(self):
         """Returns a VTableData object"""
         # TODO check overflow and write back a btree node
         save_cache = dict(self.cache)
         save_cache.update(self.shadow)
-        return VTableData(self.next_free, list(self.free), save_cache)
+        return VTableData(self.next_free, list(self.free), save_cache, dict(self.links))
 
     def new(self):
         with self.wlock:
@@ -66,11 +81,16 @@ class VTable:
         else:
             return [(inode, False) for inode in info.inodes]
 
+    def _synced(self, inodes):
+        return all(i >= 0 or i == self._HOLE for i in inodes)
+
     def is_stale(self, vnode, inode):
         """Assuming a fragment with given vnode is found at given inode,
         is it safe to be removed?"""
         infos = []
         with self.rlock:
+            if self.targets[vnode, inode]:
+                return False
             try:
                 infos.append(self.shadow[vnode])
             except KeyError:
@@ -84,7 +104,7 @@ class VTable:
         for info in infos:
             for (tin, issplit) in self._unpack_inodes(info):
                 if issplit:
-                    if tin//2 == inode//2:
+                    if tin//self.slots == inode//self.slots:
                         return False
                 elif tin == inode:
                     return False
@@ -133,17 +153,36 @@ class VTable:
             oldtime, lbsize, inodes = self.get_info(vnode)
             self.cache[vnode] = VTEntry(when, lbsize, inodes)
 
-    def trunc_inodes(self, vnode, newlen):
-        """truncates the inode list to the given length"""
+    def trunc_inodes(self, vnode, newlen, lbsize=None):
+        """truncates the inode list to the given length. The last block is
+        then taken to be full, unless its new size is given (for a hole)."""
         now = time.time()
         with self.wlock:
-            prevtime, lbsize, inodes = self.get_info(vnode)
+            prevtime, _, inodes = self.get_info(vnode)
             assert newlen < len(inodes)
             inodes = inodes[:newlen]
-            if vnode in self.shadow and all(i>=0 for i in inodes):
+            if vnode in self.shadow and self._synced(inodes):
                 # totally synced; drop from shadow
                 del self.shadow[vnode]
-            self.cache[vnode] = VTEntry(now, self.fbsize, inodes)
+            self.cache[vnode] = VTEntry(now, lbsize or self.fbsize, inodes)
+
+    def add_holes(self, vnode, num, lbsize):
+        """Extends the inode list with holes up to num blocks, the last of
+        lbsize bytes. The current last block must be full, or a hole."""
+        now = time.time()
+        with self.wlock:
+            prevtime, curlbs, inodes = self.get_info(vnode)
+            assert num >= len(inodes) and (curlbs == self.fbsize or inodes[-1] == self._HOLE)
+            inodes = inodes + [self._HOLE] * (num - len(inodes))
+            self.cache[vnode] = VTEntry(now, lbsize, inodes)
+
+    def is_hole(self, vnode, boff):
+        return self.get_info(vnode).inodes[boff] == self._HOLE
+
+    def block_size(self, vnode, boff):
+        """The size of the given block of vnode."""
+        info = self.get_info(vnode)
+        return info.lbsize if boff == len(info.inodes) - 1 else self.fbsize
 
     def change_inode(self, vnode, boff, size):
         """sets the given vnode list at offset boff to a value that indicates
@@ -153,12 +192,13 @@ class VTable:
         with self.wlock:
             prevtime, lbsize, inodes = self.get_info(vnode)
             if vnode not in self.shadow:
-                assert all(inode >= 0 for inode in inodes)
+                assert self._synced(inodes)
                 self.shadow[vnode] = VTEntry(prevtime, lbsize, list(inodes))
-            if boff == len(inodes):
-                # appending; make sure previous block is full
+            if boff >= len(inodes):
+                # appending, past holes if need be; make sure previous block is full
                 if lbsize != self.fbsize:
                     raise ValueError("Invalid block size; can't append until last block is full.")
+                inodes.extend([self._HOLE] * (boff - len(inodes)))
                 inodes.append(self._STALE)
                 lbsize = size
             elif boff == len(inodes)-1:
@@ -178,13 +218,76 @@ class VTable:
         This doesn't change the modification time; it should be called when you are
         syncing something to the backend."""
         with self.wlock:
+            # any reference this made to inode before it was reused is dead
+            self.links.pop((vnode, boff, inode), None)
             mtime, lbsize, inlst = self.get_info(vnode)
             inlst[boff] = inode
             self.cache[vnode] = VTEntry(mtime, lbsize, inlst)
-            if vnode in self.shadow and all(i>=0 for i in inlst):
+            if vnode in self.shadow and self._synced(inlst):
                 # totally synced; drop shadow copy
                 del self.shadow[vnode]
 
+    def move_splits(self, moves):
+        """Given (vnode, old, new) tuples, notes that the split last block
+        of each vnode, found in the block of inode old, was moved to inode
+        new, in both the current and the shadow entry (whichever refer to
+        it). The moves are simultaneous, so one may go where another left."""
+        with self.wlock:
+            found = []
+            for vnode, old, new in moves:
+                for info in (self.cache.get(vnode), self.shadow.get(vnode)):
+                    if (info is not None and info.inodes and info.lbsize <= self.sbmax
+                            and info.inodes[-1] >= 0 and info.inodes[-1]//self.slots == old//self.slots):
+                        found.append((info.inodes, new))
+            for inodes, new in found:
+                inodes[-1] = new
+
+    def link(self, vnode, boff, owner, inode):
+        """Makes fragment boff of vnode (already changed with change_inode)
+        a reference to the full fragment of owner stored at inode."""
+        with self.wlock:
+            self.set_inode(vnode, boff, inode)
+            self.links[vnode, boff, inode] = owner
+            self.targets[owner, inode] += 1
+
+    def owner(self, vnode, boff, inode):
+        """The vnode that fragment boff of vnode, found at inode, is stored
+        under in the backend."""
+        return self.links.get((vnode, boff, inode), vnode)
+
+    def prune_links(self):
+        """Forgets references that neither the current nor the shadow entry
+        of their vnode still uses, and recounts targets."""
+        with self.wlock:
+            def live(vnode, boff, inode):
+                for info in (self.shadow.get(vnode), self.cache.get(vnode)):
+                    if info is not None and boff < len(info.inodes) and info.inodes[boff] == inode:
+                        return True
+                return False
+            self.links = {key: owner for (key, owner) in self.links.items() if live(*key)}
+            self.targets = collections.Counter((owner, inode)
+                    for ((vnode, boff, inode), owner) in self.links.items())
+
+    def restore(self, vnode, entry, shadow=None):
+        """Overwrites everything known about vnode, e.g. when replaying a log.
+        entry None means the vnode doesn't exist.
+        Call reindex() afterwards to fix up the free list."""
+        with self.wlock:
+            self.shadow.pop(vnode, None)
+            if entry is None:
+                self.cache.pop(vnode, None)
+            else:
+                self.cache[vnode] = entry
+                if shadow is not None:
+                    self.shadow[vnode] = shadow
+
+    def reindex(self):
+        """Recomputes next_free and the free list from the stored vnodes."""
+        with self.wlock:
+            self.next_free = max(self.cache, default=self._ROOT_VNODE) + 1
+            self.free = set(range(self._ROOT_VNODE+1, self.next_free))
+            self.free.difference_update(self.cache)
+
     def get_info(self, vnode):
         with self.rlock:
             if vnode in self.free:
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import sys
+import collections
+
+from segments import SegmentLog
+from vtable import VTable
+
+class WriteAheadLog:
+    """Locally records everything a WoOram holds that isn't yet in the
+    backend, namely buffered fragments and the vtable entries that refer
+    to them, so that the buffer can keep draining after a restart.
+
+    Records are appended to an encrypted SegmentLog:
+        ('frag', vnode, boff, data)       a fragment was buffered
+        ('vt', vnode, entry, shadow)      the vtable entry for vnode changed
+        ('ln', vnode, boff, inode, owner) a fragment became a reference
+        ('ck', {vnode: (entry, shadow)})  checkpoint after a superblock save
+    A checkpoint holds every vnode still waiting to be synced; vtable
+    records before the latest checkpoint are already reflected in the
+    superblock. Segments before the latest checkpoint are deleted as soon
+    as all of their fragments have been synced.
+    """
+
+    def __init__(self, directory, crypt, segsize=2**26):
+        self.log = SegmentLog(directory, crypt, prefix="wal", segsize=segsize)
+        self.live = {} # (vnode, boff) -> segno of its latest frag record
+        self.changed = False # anything logged since the last checkpoint
+
+    def frag(self, vnode, boff, data):
+        segno, _ = self.log.append(('frag', vnode, boff, data))
+        self.live[vnode, boff] = segno
+        self.changed = True
+
+    def entry(self, vnode, vtable):
+        """Logs the current vtable state of vnode."""
+        try:
+            entry = vtable.get_info(vnode)
+        except KeyError:
+            entry = None
+        self.log.append(('vt', vnode, entry, vtable.shadow.get(vnode)))
+        self.changed = True
+
+    def link(self, vnode, boff, inode, owner):
+        """Logs a deduplication reference (see VTable.link)."""
+        self.log.append(('ln', vnode, boff, inode, owner))
+        self.changed = True
+
+    def discard(self, items):
+        """Given a list of (vnode, boff) pairs that have left the buffer,
+        forgets their frag records."""
+        for x in items:
+            self.live.pop(x, None)
+
+    def checkpoint(self, vtable, synced=True):
+        """Should be called right after the superblock was saved from
+        vtable, while it is still locked. synced says whether any
+        fragments were moved to the backend since the last checkpoint."""
+        if not self.changed and not synced:
+            return
+        self.log.append(('ck', {v: (vtable.cache[v], sh)
+            for (v, sh) in vtable.shadow.items()}))
+        self.log.sync()
+        self.changed = False
+        needed = set(self.live.values())
+        needed.add(self.log.current())
+        for segno in list(self.log.segnos):
+            if segno >= self.log.current():
+                break
+            if segno not in needed:
+                self.log.remove(segno)
+
+    def replay(self, vtable, buf):
+        """Brings vtable (as loaded from the superblock) up to date
+        and refills buf with the fragments that are still pending."""
+        frags = collections.OrderedDict() # (vnode, boff) -> (segno, data)
+        changes = [] # vtable records since the latest checkpoint
+        links = {} # references made since the latest checkpoint
+        for (segno, off), rec in self.log.records():
+            if rec[0] == 'ln':
+                links[rec[1:4]] = rec[4]
+            elif rec[0] == 'frag':
+                key = (rec[1], rec[2])
+                frags.pop(key, None)
+                frags[key] = (segno, rec[3])
+            elif rec[0] == 'ck':
+                changes = [(vnode, entry, shadow)
+                    for (vnode, (entry, shadow)) in rec[1].items()]
+                # the superblock has the live ones; an older one could match
+                # a fragment since stored at the same inode
+                links = {}
+            else:
+                changes.append(rec[1:])
+        if not frags and not changes:
+            return
+
+        for vnode, entry, shadow in changes:
+            vtable.restore(vnode, entry, shadow)
+        vtable.reindex()
+        vtable.links.update(links)
+        vtable.prune_links()
+
+        for (vnode, boff), (segno, data) in frags.items():
+            try:
+                inodes = vtable.get_info(vnode).inodes
+            except KeyError:
+                continue
+            if boff < len(inodes) and inodes[boff] == VTable._STALE:
+                buf.set(vnode, boff, data)
+                self.live[vnode, boff] = segno
+
+        lost = sum(1 for vnode in vtable.shadow
+                for (boff, inode) in enumerate(vtable.get_info(vnode).inodes)
+                if inode == VTable._STALE and (vnode, boff) not in self.live)
+        if lost:
+            print("WARNING: write-ahead log is missing", lost, "fragments", file=sys.stderr)
+        print("Replayed", len(buf), "buffered fragments from write-ahead log", file=sys.stderr)
+        self.changed = True
+
+    def sync(self):
+        """Forces everything logged so far to disk."""
+        self.log.sync()
+
+    def close(self):
+        self.log.sync()
+        self.log.close()
@@ -7,33 +7,56 @@ import time
 import math
 import threading
 
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
 from buffer import Buffer
 from block import Block
+from dedup import DedupIndex
+from policy import Fifo
+from metrics import Metrics, Histogram
+from segments import SegmentLog
+from wal import WriteAheadLog
 from rwlock import get_rw_locks
 from vtable import VTable
 from superblock import new_superblock, load_superblock, save_superblock
 
 BUF_MEASURE=False
 DEBUG=False
+FETCH_THREADS=4 # backend blocks read (and decrypted) at once
+DRAIN_WINDOW=20 # recent busy sync rounds the drain rate is estimated from
 
 def load_wooram(backend, blocksize=2**22, total_blocks=2**10, 
-        drip_rate=3, drip_time=60, headerlen=48):
+        drip_rate=3, drip_time=60, headerlen=48, spill_dir=None, spill_mem=2**28,
+        wal_dir=None, dedup=False, policy=None, repack=False, slots=2):
     """Greedily attempts to load a wooram object from the given backend.
     If none is found stored there already, it will be created with the given
-    parameters."""
+    parameters, each backend block holding slots full fragments.
+    If spill_dir is given, buffered fragments beyond spill_mem bytes are
+    kept encrypted (with the backend's key) in that local directory.
+    If wal_dir is given, pending writes are logged there (also encrypted),
+    anything left over from last time is replayed, and finish() returns
+    without waiting for the buffer to drain.
+    With dedup, full fragments identical to ones already set are stored
+    only once (see WoOram._dedup). policy (a policy.Policy) decides which
+    buffered fragments each sync round tries first; by default, the oldest.
+    With repack, each round packs the small fragments of all the evicted
+    blocks together (see WoOram._repack)."""
     sup = None
     try:
         sup = load_superblock(backend)
         if (blocksize != sup.blocksize or total_blocks != sup.total_blocks 
-                or headerlen != sup.headerlen):
+                or headerlen != sup.headerlen or slots != sup.slots):
             print("WARNING: Some parameters differ from superblock and will be ignored.")
         print("Successfully loaded WoOram from superblock")
     except ValueError:
-        sup = new_superblock(blocksize, total_blocks, headerlen)
-    return WoOram(backend, sup, drip_rate, drip_time)
+        sup = new_superblock(blocksize, total_blocks, headerlen, slots)
+    wal = None if wal_dir is None else WriteAheadLog(wal_dir, backend)
+    return WoOram(backend, sup, drip_rate, drip_time, spill_dir, spill_mem, wal, dedup, policy, repack)
 
 class WoOram:
-    def __init__(self, backend, sup, drip_rate, drip_time):
+    def __init__(self, backend, sup, drip_rate, drip_time,
+            spill_dir=None, spill_mem=2**28, wal=None, dedup=False, policy=None, repack=False):
         self.backend = backend
         self.vtable = sup.vtable
         self.blocksize = sup.blocksize
@@ -44,15 +67,46 @@ class WoOram:
         self.fbsize = sup.fbsize
         self.split_maxnum = sup.split_maxnum
         self.split_maxsize = sup.split_maxsize
+        self.slots = sup.slots # fragments per backend block
+        self.generation = sup.generation # bumped on every superblock save
 
-        self.buf = Buffer()
+        if spill_dir is None:
+            self.buf = Buffer()
+        else:
+            self.buf = Buffer(SegmentLog(spill_dir, backend, prefix="spill"),
+                    mem_limit=spill_mem)
+        self.wal = wal
+        if wal is not None:
+            wal.replay(self.vtable, self.buf)
         self.rlock, self.wlock = get_rw_locks()
         self.syncer = Syncer(self, self.T)
 
         self.active = False # is the sync thread running
         self.syncing = False # is a sync operation in progress
+        # has the vtable changed since a sync round began (as replaying the
+        # write-ahead log may have)
+        self.unsaved = wal is not None
         self.recent = None # set of (vnode, boff) pairs for what has changed during the sync op
 
+        self.metrics = Metrics() # per-round measurements from sync()
+        self.last_round = None # the measurements from the most recent round
+        self.before_sync = None # called at the start of each sync round
+        self.fetchers = ThreadPoolExecutor(FETCH_THREADS)
+
+        self.dedup = DedupIndex() if dedup else None
+        self.pending = {} # (vnode, boff) -> identical buffered (vnode, boff)
+        self.dependents = defaultdict(set) # the reverse of pending
+        self.deduped = 0 # fragments not buffered, since the last round
+
+        self.policy = Fifo() if policy is None else policy
+        self.repack = repack
+        # (vnode, index) of old copies of fragments that _repack moved, which
+        # the last saved superblock may still point to; see _repack
+        self.moved = set()
+        self.rounds = 0 # sync rounds so far
+        self.unsynced = {} # vnode -> round when it last stopped being fully synced
+        self.drained = deque(maxlen=DRAIN_WINDOW) # bytes packed by recent rounds with a backlog
+
     def start(self):
         if self.T > 0:
             self.active = True
@@ -61,11 +115,16 @@ class WoOram:
             print("NOTE: sync thread not actually started...")
 
     def finish(self):
-        """Waits until the buffer has been cleared, then stops the syncer and returns."""
+        """Waits until the buffer has been cleared, then stops the syncer and returns.
+        With a write-ahead log, only waits for the current sync operation;
+        the rest of the buffer is drained after the next load."""
         if self.active:
             self.active = False
             print("Waiting for the sync thread to finish...", file=sys.stderr)
             self.syncer.join()
+            self.buf.close()
+        if self.wal is not None:
+            self.wal.close()
 
     def __enter__(self):
         self.start()
@@ -98,22 +157,101 @@ class WoOram:
     def set_mtime(self, vnode, when=None):
         if when is None:
             when = time.time()
-        self.vtable.set_mtime(vnode, when)
+        with self.wlock:
+            self.unsaved = True
+            self.vtable.set_mtime(vnode, when)
+            if self.wal: self.wal.entry(vnode, self.vtable)
+
+    def fsync(self):
+        """Makes everything set so far survive a crash, as far as possible:
+        with a write-ahead log, forces it to disk. Without one, data is
+        only safe once the buffer has drained to the backend."""
+        if self.wal is not None:
+            with self.wlock:
+                self.wal.sync()
+
+    def idle(self):
+        """Whether everything set so far is in the last superblock saved, so
+        that no sync round is needed. Changes that buffer nothing (deleting,
+        truncating, extending with holes...) still need one."""
+        with self.rlock:
+            return not self.buf and not self.vtable.has_shadow() and not self.unsaved
 
     def capacity(self):
         """The total space avaiable (in bytes) in the backend."""
         return self.blocksize * self.N
 
-    def _make_block(self, b1, b2):
-        """Creates a new block with the given contents on either side.
-        Each should be a Block object.
+    def sync_stats(self):
+        """Summaries of the recent sync rounds, as a dict mapping each
+        measurement name to a dict with count, mean, min, p50, p90, p99 and
+        max. Times are in seconds and sizes in bytes."""
+        return self.metrics.summary()
+
+    def drain_rate(self):
+        """Bytes moved from the buffer to the backend per sync round, on
+        average over the recent rounds that had something to move. Until
+        there are any, what K blocks could hold at most."""
+        busy = list(self.drained)
+        if sum(busy) > 0:
+            return sum(busy) / len(busy)
+        return self.K * (self.blocksize - self.headerlen)
+
+    def eta(self, vnode):
+        """Estimates when everything set so far for vnode will be readable
+        by other clients, assuming fragments leave the buffer in FIFO order
+        at the recent drain rate. Returns a dict with the bytes and number
+        of its fragments still buffered, the bytes buffered up to its last
+        one, how long (in seconds) the oldest has waited, and the estimated
+        rounds and seconds left."""
+        with self.rlock:
+            nbytes, nfrags, ahead, since = self.buf.backlog(vnode)
+            synced = vnode not in self.vtable.shadow
+        if nfrags:
+            rounds = math.ceil(ahead / self.drain_rate())
+        else:
+            # at most waiting for the next superblock to be written
+            rounds = 0 if synced else 1
+        return dict(pending_bytes=nbytes, pending_frags=nfrags, bytes_ahead=ahead,
+                waiting=0 if since is None else time.time() - since,
+                eta_rounds=rounds, eta_seconds=rounds * self.T)
+
+    def backlog(self):
+        """Volume-wide counterpart of eta(): what is buffered, a histogram
+        of how long (in seconds) fragments have waited, and the estimated
+        rounds and seconds until the buffer drains."""
+        with self.rlock:
+            ages = self.buf.ages()
+            pending = self.buf.pending()
+            unsynced = len(self.vtable.shadow)
+        hist = Histogram(unit=1)
+        for age in ages:
+            hist.add(age)
+        nbytes = sum(size for (vnode, boff, size) in pending)
+        per_round = self.drain_rate()
+        rounds = math.ceil(nbytes / per_round)
+        return dict(buffer_bytes=nbytes, buffer_frags=len(pending),
+                buffer_files=len({vnode for (vnode, boff, size) in pending}),
+                unsynced_files=unsynced, age=hist.summary(),
+                age_buckets={2**i: n for (i, n) in enumerate(hist.buckets) if n},
+                drain_bytes_per_round=per_round, eta_rounds=rounds,
+                eta_seconds=rounds * self.T)
+
+    def _make_block(self, blist):
+        """Creates a new block with the given contents in each slot.
+        blist should be a list of self.slots Block objects.
         The block is padded up to self.blocksize.
         """
         # TODO make more efficiently indexable storage representation?
-        block = pickle.dumps((b1.contents, b2.contents))
+        block = pickle.dumps(tuple(b.contents for b in blist))
         assert len(block) <= self.blocksize - self.headerlen
         return block + b'\0'*(self.blocksize - len(block) - self.headerlen)
 
+    def _save_superblock(self):
+        self.generation += 1
+        save_superblock(self.backend, 
+                self.vtable, self.blocksize, self.N, self.headerlen, self.generation,
+                self.slots)
+
     def _get_backend(self, ind):
         """Returns a tuple of block objects stored at the given index."""
         res = []
@@ -146,23 +284,36 @@ class WoOram:
                     res = None
                     break
                 res.append(Block(self, kind, contents))
-        if res is None or len(res) != 2:
-            return tuple(Block(self, Block.EMPTY) for _ in range(2))
+        if res is None or len(res) != self.slots:
+            return tuple(Block(self, Block.EMPTY) for _ in range(self.slots))
         else:
             return tuple(res)
 
+    def _get_backends(self, inds):
+        """Like _get_backend for each of a list of indices, reading them
+        in parallel."""
+        if len(inds) <= 1:
+            return [self._get_backend(ind) for ind in inds]
+        return list(self.fetchers.map(self._get_backend, inds))
+
     def _get_fresh(self, ind):
-        """Gets the pair of Blocks stored at the given index,
+        """Gets the Blocks stored at the given index,
         after removing anything that's stale."""
+        with self.rlock:
+            return self._drop_stale(ind, self._get_backend(ind))
+
+    def _drop_stale(self, ind, parts):
+        """Given the Blocks stored at the given index,
+        returns them with anything that's stale removed."""
         res = []
-        inode0 = 2*ind
+        inode0 = self.slots*ind
         with self.rlock:
-            parts = self._get_backend(ind)
             for j, blk in enumerate(parts):
                 inode = inode0+j
                 if blk.kind() == Block.SPLIT:
-                    stale = [vnode for vnode in blk.contents 
-                            if self.vtable.is_stale(vnode, inode)]
+                    stale = [vnode for vnode in blk.contents
+                            if (vnode, ind) not in self.moved
+                            and self.vtable.is_stale(vnode, inode)]
                     for vnode in stale:
                         del blk.contents[vnode]
                     if len(blk.contents) == 0:
@@ -175,17 +326,107 @@ class WoOram:
                 res.append(blk)
         return res
 
+    def _compact(self, blist):
+        """Merges the split slots of one evicted block into as few as
+        possible, each smallest into the fullest that can take it all.
+        Returns the number of slots emptied."""
+        splits = sorted((b for b in blist if b.kind() == Block.SPLIT), key=Block.size)
+        merged = 0
+        while len(splits) > 1:
+            src = splits.pop(0)
+            for dst in reversed(splits):
+                if (dst.size() + src.size() <= self.split_maxsize
+                        and len(dst.contents) + len(src.contents) <= self.split_maxnum):
+                    dst.contents.update(src.contents)
+                    blist[[b is src for b in blist].index(True)] = Block(self, Block.EMPTY)
+                    merged += 1
+                    break
+            else:
+                break # the others are bigger, so won't fit either
+            splits.sort(key=Block.size)
+        return merged
+
+    def _repack(self, evict_ind, evict_blocks):
+        """Bin-packs every live fragment in the split slots of the evicted
+        blocks into as few slots as possible, largest first, leaving the
+        rest empty for full fragments. Replaces the slots in evict_blocks
+        and returns a list of (vnode, old inode, new inode) for fragments
+        that moved to another block, or None, changing nothing, if they
+        don't all fit or one vnode has two of them.
+
+        A fragment that moves is copied: the old copy stays in its block
+        (in any split slot), since readers, and the saved superblock, still
+        point there until the vtable is changed, after the superblock
+        is saved. It is dropped as stale once a later superblock is saved."""
+        if any((vnode, ind) in self.moved for ind, blist in zip(evict_ind, evict_blocks)
+                for blk in blist if blk.kind() == Block.SPLIT for vnode in blk.contents):
+            # an old copy has to stay where it is for now
+            return None
+        frags = []
+        for ind, blist in zip(evict_ind, evict_blocks):
+            for j, blk in enumerate(blist):
+                if blk.kind() == Block.SPLIT:
+                    frags.extend((len(data), vnode, data, self.slots*ind+j)
+                            for (vnode, data) in blk.contents.items())
+        if len({f[1] for f in frags}) < len(frags):
+            # a vnode's shadow and current entries each have a split
+            # fragment here; swapping them between blocks would leave
+            # each old copy on top of the other version
+            return None
+        frags.sort(key=lambda f: -f[0])
+        new = [[Block(self, Block.EMPTY) if b.kind() == Block.SPLIT else b for b in blist]
+                for blist in evict_blocks]
+        moves = []
+        copies = []
+        for size, vnode, data, old in frags:
+            # best fit (but see _holds_split)
+            best = None
+            for i, blist in enumerate(new):
+                if _holds_split(blist, vnode):
+                    continue
+                for j, b in enumerate(blist):
+                    if b.kind() != Block.FULL and size <= b.space_avail() and (best is None
+                            or b.space_avail() < new[best[0]][best[1]].space_avail()):
+                        best = (i, j)
+            if best is None:
+                return None
+            i, j = best
+            if new[i][j].kind() == Block.EMPTY:
+                new[i][j] = Block(self, Block.SPLIT, {})
+            new[i][j].contents[vnode] = data
+            inode = self.slots*evict_ind[i] + j
+            if inode//self.slots != old//self.slots:
+                moves.append((vnode, old, inode))
+                copies.append((size, vnode, data, evict_ind.index(old//self.slots)))
+        # keep the old copies, each in the fullest slot of its block with room
+        for size, vnode, data, i in copies:
+            fits = [j for j, b in enumerate(new[i])
+                    if b.kind() != Block.FULL and size <= b.space_avail()]
+            if not fits:
+                return None
+            j = min(fits, key=lambda j: new[i][j].space_avail())
+            if new[i][j].kind() == Block.EMPTY:
+                new[i][j] = Block(self, Block.SPLIT, {})
+            new[i][j].contents[vnode] = data
+        for blist, nlist in zip(evict_blocks, new):
+            blist[:] = nlist
+        return moves
+
     def _fetch_block_inode(self, vnode, inode, split):
         """Gets the contents of the given vnode stored in backend at the given
         inode. split is a bool indicating whether it's an sblock."""
-        assert 0 <= inode < 2*self.N
-        parts = self._get_backend(inode//2)
+        assert 0 <= inode < self.slots*self.N
+        return self._from_parts(self._get_backend(inode//self.slots), vnode, inode, split)
+
+    def _from_parts(self, parts, vnode, inode, split):
+        """Picks the contents of the given vnode out of the Blocks
+        stored at inode//self.slots."""
         if split:
             for blk in parts:
                 if blk.kind() == Block.SPLIT and vnode in blk.contents:
                     return blk.contents[vnode]
         else:
-            blk = parts[inode % 2]
+            blk = parts[inode % self.slots]
             if blk.kind() == Block.FULL and blk.contents[0] == vnode:
                 return blk.contents[1]
         return None
@@ -193,10 +434,13 @@ class WoOram:
     def _fetch_backend(self, vnode, boff):
         with self.rlock:
             inode, split = self.vtable.get_inodes(vnode)[boff]
-            if inode < 0:
+            if inode == VTable._HOLE:
+                return bytes(self.vtable.block_size(vnode, boff))
+            elif inode < 0:
                 return None
             else:
-                return self._fetch_block_inode(vnode, inode, split)
+                owner = self.vtable.owner(vnode, boff, inode)
+                return self._fetch_block_inode(owner, inode, split)
 
     def get(self, vnode, boff):
         """Returns a bytes object for the specified data fragment.
@@ -205,58 +449,178 @@ class WoOram:
         None if the data is inaccessible for some other reason.
         """
         with self.rlock:
-            res = self.buf.get(vnode, boff)
+            res = self._buffered(vnode, boff)
             if res is None:
                 res = self._fetch_backend(vnode, boff)
         if DEBUG: print("wooram: get: buf[{}:{}]=>len({})".format(vnode,boff,len(res) if res else None), file=sys.stderr)
         return res
 
+    def get_many(self, keys):
+        """Returns the fragments for a list of (vnode, boff) pairs, in the
+        same order, as get would. Those not in the buffer are resolved
+        against one vtable snapshot, and each backend block holding any of
+        them is fetched once, several in parallel."""
+        res = [None] * len(keys)
+        with self.rlock:
+            wanted = defaultdict(list) # backend index -> [(i, vnode, inode, split)]
+            for i, (vnode, boff) in enumerate(keys):
+                res[i] = self._buffered(vnode, boff)
+                if res[i] is None:
+                    inode, split = self.vtable.get_inodes(vnode)[boff]
+                    if inode == VTable._HOLE:
+                        res[i] = bytes(self.vtable.block_size(vnode, boff))
+                    elif inode >= 0:
+                        owner = self.vtable.owner(vnode, boff, inode)
+                        wanted[inode//self.slots].append((i, owner, inode, split))
+            inds = sorted(wanted)
+            for ind, parts in zip(inds, self._get_backends(inds)):
+                for i, vnode, inode, split in wanted[ind]:
+                    res[i] = self._from_parts(parts, vnode, inode, split)
+        if DEBUG: print("wooram: get_many: {} fragments from {} blocks".format(len(keys),len(wanted)), file=sys.stderr)
+        return res
+
     def set(self, vnode, boff, data):
         if len(data) == 0:
             raise ValueError("can't set fragment to empty. Use resize instead.")
 
         with self.wlock:
+            self.unsaved = True
             if self.syncing: self.recent.add((vnode, boff))
+            self.unsynced.setdefault(vnode, self.rounds)
+            self.policy.note_set(vnode, boff, self.rounds)
+            self._release(vnode, boff)
+            if self.dedup is not None and len(data) > self.split_maxsize and self._dedup(vnode, boff, data):
+                return
             self.vtable.change_inode(vnode, boff, len(data))
             self.buf.set(vnode, boff, data)
+            if self.wal:
+                self.wal.frag(vnode, boff, data)
+                self.wal.entry(vnode, self.vtable)
 
         if DEBUG: print("wooram: set: buf[{}:{}]<=len({})".format(vnode,boff,len(data) if data else None), file=sys.stderr)
 
+    def _buffered(self, vnode, boff):
+        """The buffered data of the given fragment, if any, including one
+        waiting to reference an identical buffered fragment."""
+        return self.buf.get(*self.pending.get((vnode, boff), (vnode, boff)))
+
+    def _dedup(self, vnode, boff, data):
+        """Called by set (with wlock held) for a full fragment. If one with
+        identical contents is already stored, the fragment becomes a
+        reference to it in the vtable; if one is buffered, it waits for
+        that one to be stored and then does the same. Either way nothing
+        new is buffered, and True is returned."""
+        digest = self.dedup.digest(data)
+        src = self.dedup.find(digest)
+        self.dedup.add(vnode, boff, digest)
+        if src is None:
+            return False
+        src = self.pending.get(src, src)
+        inode, split = self.vtable.get_inodes(src[0])[src[1]]
+        if inode >= 0 and not split:
+            self.buf.pop([(vnode, boff)])
+            self.vtable.change_inode(vnode, boff, len(data))
+            self.vtable.link(vnode, boff, self.vtable.owner(src[0], src[1], inode), inode)
+            if self.wal:
+                self.wal.discard([(vnode, boff)])
+                self.wal.link(vnode, boff, inode, self.vtable.owner(vnode, boff, inode))
+        elif src in self.buf:
+            self.buf.pop([(vnode, boff)])
+            self.vtable.change_inode(vnode, boff, len(data))
+            self.pending[vnode, boff] = src
+            self.dependents[src].add((vnode, boff))
+            if self.wal:
+                # replayed as an ordinary copy
+                self.wal.frag(vnode, boff, data)
+        else:
+            return False
+        if self.wal: self.wal.entry(vnode, self.vtable)
+        self.deduped += 1
+        if DEBUG: print("wooram: dedup: {}:{} same as {}:{}".format(vnode,boff,*src), file=sys.stderr)
+        return True
+
+    def _release(self, vnode, boff):
+        """Called (with wlock held) before a fragment changes or goes away.
+        Those waiting to reference it get a copy of its data instead."""
+        if self.dedup is None:
+            return
+        self.dedup.drop(vnode, boff)
+        src = self.pending.pop((vnode, boff), None)
+        if src is not None:
+            self.dependents[src].discard((vnode, boff))
+            if not self.dependents[src]:
+                del self.dependents[src]
+        deps = self.dependents.pop((vnode, boff), ())
+        if deps:
+            data = self.buf.get(vnode, boff)
+            for dep in deps:
+                del self.pending[dep]
+                self.buf.set(dep[0], dep[1], data)
+
+    def _resolve(self, vnode, boff, inode):
+        """Called (with wlock held) once a fragment is stored at inode;
+        those waiting to reference it now do. Returns them."""
+        deps = self.dependents.pop((vnode, boff), ())
+        for dep in deps:
+            del self.pending[dep]
+            self.vtable.link(dep[0], dep[1], vnode, inode)
+            if self.wal: self.wal.link(dep[0], dep[1], inode, vnode)
+        return deps
+
     def new(self):
-        return self.vtable.new()
+        with self.wlock:
+            self.unsaved = True
+            vnode = self.vtable.new()
+            if self.wal: self.wal.entry(vnode, self.vtable)
+        return vnode
 
     def delete(self, vnode):
         with self.wlock:
+            self.unsaved = True
             size = self.num_blocks(vnode)
             if self.syncing:
                 self.recent.update((vnode, boff) for boff in range(size))
+            for boff in range(size):
+                self._release(vnode, boff)
             self.buf.pop((vnode, boff) for boff in range(size))
             del self.vtable[vnode]
+            self.unsynced.pop(vnode, None)
+            if self.wal:
+                self.wal.discard((vnode, boff) for boff in range(size))
+                self.wal.entry(vnode, self.vtable)
 
     def resize(self, vnode, size):
         """sets the length in bytes of vnode to the given value."""
         num = math.ceil(size / self.fbsize)
         lbsize = size - self.fbsize*(num-1)
         with self.wlock:
+            self.unsaved = True
             info = self.vtable.get_info(vnode)
             curnum = len(info.inodes)
             curlbs = info.lbsize
             if num < curnum:
-                # truncating
-                self.vtable.trunc_inodes(vnode, num)
-                if lbsize < self.fbsize:
+                # truncating; a hole at the new end needs nothing set
+                hole = num > 0 and info.inodes[num-1] == VTable._HOLE
+                self.vtable.trunc_inodes(vnode, num, lbsize if hole else None)
+                gone = [(vnode, boff) for boff in range(num, curnum)]
+                for boff in range(num, curnum):
+                    self._release(vnode, boff)
+                if self.syncing: self.recent.update(gone)
+                self.buf.pop(gone)
+                if self.wal: self.wal.discard(gone)
+                if lbsize < self.fbsize and not hole:
                     data = self.get(vnode, num-1)[:lbsize]
                     self.set(vnode, num-1, data)
             elif num > curnum:
-                # growing
-                if curlbs < self.fbsize:
+                # growing; the new blocks are holes, which are never stored
+                if curlbs < self.fbsize and not self.vtable.is_hole(vnode, curnum-1):
                     # need to pad last block with null bytes
                     data = self.get(vnode, curnum-1) + b'\0'*(self.fbsize - curlbs)
                     assert len(data) == self.fbsize
                     self.set(vnode, curnum-1, data)
-                for boff in range(curnum, num-1):
-                    self.set(vnode, boff, b'\0'*self.fbsize)
-                self.set(vnode, num-1, b'\0'*lbsize)
+                self.vtable.add_holes(vnode, num, lbsize)
+            elif lbsize != curlbs and self.vtable.is_hole(vnode, num-1):
+                self.vtable.add_holes(vnode, num, lbsize)
             elif lbsize != curlbs:
                 data = self.get(vnode, num-1)
                 if lbsize < curlbs:
@@ -265,8 +629,14 @@ class WoOram:
                 else:
                     # growing last block
                     self.set(vnode, num-1, data + b'\0'*(lbsize-curlbs))
+            if self.wal: self.wal.entry(vnode, self.vtable)
 
     def sync(self):
+        clock = time.perf_counter
+        start = clock()
+        if self.before_sync is not None:
+            # e.g. to write back pending metadata before anything is snapshotted
+            self.before_sync()
         evict_ind = random.sample(range(1,self.N), self.K)
 
         with self.wlock:
@@ -276,58 +646,137 @@ class WoOram:
                 print("This sync attempt is aborting. Your privacy may be compromised.")
                 return
             self.syncing = True
+            self.unsaved = False
             self.recent = set()
+            self.vtable.prune_links()
+            deduped, self.deduped = self.deduped, 0
 
         with self.rlock:
-            evict_blocks = [self._get_fresh(ind) for ind in evict_ind]
-            avail = self.buf.available()
-
-        # compute available space, pre-compacting sblocks when possible
-        for blist in evict_blocks:
-            if all(b.kind() == Block.SPLIT for b in blist):
-                # two sblocks. can they fit into one?
-                if sum(b.size() for b in blist) <= self.split_maxsize:
-                    # yes!
-                    blist[0].contents.update(blist[1].contents)
-                    blist[1] = Block(self, Block.EMPTY)
+            fetched = self._get_backends(evict_ind)
+            t_fetch = clock()
+            evict_blocks = [self._drop_stale(ind, parts)
+                    for (ind, parts) in zip(evict_ind, fetched)]
+            t_stale = clock()
+            avail = self.buf.pending()
+            buf_bytes = self.buf.size()
+            oldest = max(self.buf.ages(), default=0)
+
+        # compute available space, repacking or pre-compacting sblocks
+        compacted = 0
+        moves = self._repack(evict_ind, evict_blocks) if self.repack else None
+        if moves is None:
+            moves = []
+            for blist in evict_blocks:
+                compacted += self._compact(blist)
 
         blocks = [b for blist in evict_blocks for b in blist]
-        assert len(blocks) == 2*self.K
+        assert len(blocks) == self.slots*self.K
+        block_of = {id(b): blist for blist in evict_blocks for b in blist}
+        with self.rlock:
+            # set() tells the policy about new fragments under wlock
+            avail = self.policy.order(avail, sum(b.space_avail() for b in blocks), self.rounds)
 
         # pack items from the buffer
         to_pop = []
-        for vnode, boff, data in avail:
-            assert len(data) > 0
+        packed = 0
+        packed_bytes = 0
+        for vnode, boff, size in avail:
+            assert size > 0
             # try every block, sorting smallest first so best-fit
             blocks.sort(key=lambda b: b.space_avail())
+            if blocks[-1].space_avail() == 0:
+                # everything is full
+                break
+            data = None
             for b in blocks:
-                if b.add_if(vnode, boff, data):
-                    break
+                if b.fits(size) and (size > self.split_maxsize
+                        or not _holds_split(block_of[id(b)], vnode)):
+                    # only now read the data, which may have been spilled
+                    if data is None:
+                        with self.rlock:
+                            data = self.buf.get(vnode, boff)
+                        if data is None:
+                            break
+                    if b.add_if(vnode, boff, data):
+                        packed += 1
+                        packed_bytes += len(data)
+                        break
+        payload = sum(b.size() for b in blocks)
+        t_pack = clock()
 
         # write back blocks to backend
-        for ind, (b1, b2) in zip(evict_ind, evict_blocks):
-            self.backend[ind] = self._make_block(b1,b2)
+        for ind, blist in zip(evict_ind, evict_blocks):
+            self.backend[ind] = self._make_block(blist)
+        t_write = clock()
 
         with self.wlock:
             # update vtable for what was added
             for i, blist in enumerate(evict_blocks):
-                inode0 = 2*evict_ind[i]
-                for j in range(2):
+                inode0 = self.slots*evict_ind[i]
+                for j in range(self.slots):
                     for (vnode, boff) in blist[j].added():
                         if (vnode,boff) not in self.recent:
                             self.vtable.set_inode(vnode, boff, inode0+j)
                             to_pop.append((vnode, boff))
+                            if self.dedup is not None:
+                                to_pop.extend(self._resolve(vnode, boff, inode0+j))
+            # how many rounds files took to become readable by other clients
+            visible = [v for v in self.unsynced if v not in self.vtable.shadow]
+            for vnode in visible:
+                self.metrics.add("visible_rounds", self.rounds - self.unsynced.pop(vnode))
+            self.rounds += 1
+            if avail: self.drained.append(packed_bytes)
+        t_vtable = clock()
 
         with self.rlock:
-            save_superblock(self.backend, 
-                    self.vtable, self.blocksize, self.N, self.headerlen)
+            self._save_superblock()
+            if self.wal: self.wal.checkpoint(self.vtable, bool(to_pop))
+        t_super = clock()
 
         with self.wlock:
+            # only now that the superblock still pointing to the old copies
+            # of what was moved is saved, point to the new ones (see _repack)
+            self.vtable.move_splits(moves)
+            self.moved = {(vnode, old//self.slots) for (vnode, old, new) in moves}
             # now that all is set, remove added items from buffer
             self.buf.pop(to_pop)
+            if self.wal: self.wal.discard(to_pop)
             self.recent = None
             self.syncing = False
 
+        written = self.K * (self.blocksize - self.headerlen)
+        self.last_round = dict(
+                time_fetch = t_fetch - start,
+                time_stale = t_stale - t_fetch,
+                time_pack = t_pack - t_stale,
+                time_write = t_write - t_pack,
+                time_vtable = t_vtable - t_write,
+                time_superblock = t_super - t_vtable,
+                time_round = clock() - start,
+                bytes_payload = payload,
+                bytes_padding = written - payload,
+                bytes_packed = packed_bytes,
+                frags_packed = packed,
+                frags_synced = len(to_pop),
+                compactions = compacted,
+                frags_moved = len(moves),
+                frags_deduped = deduped,
+                dedup_refs = len(self.vtable.links),
+                files_visible = len(visible),
+                buffer_frags = len(avail),
+                buffer_bytes = buf_bytes,
+                buffer_age = oldest,
+                )
+        self.last_round.update(self.policy.last)
+        self.metrics.record(self.last_round)
+
+
+def _holds_split(blist, vnode):
+    """Whether any of the Blocks in one backend block holds a split
+    fragment of vnode. It must never hold two, since lookups search every
+    slot: the
+    older would be taken for the newer, and never be dropped as stale."""
+    return any(b.kind() == Block.SPLIT and vnode in b.contents for b in blist)
 
 class Syncer(threading.Thread):
     def __init__(self, woo, T):
@@ -348,8 +797,7 @@ class Syncer(threading.Thread):
             time.sleep(self.T - elapsed)
             prev_start = time.time()
             with self.woo.rlock:
-                if (not self.woo.active and not self.woo.buf 
-                        and not self.woo.vtable.has_shadow()):
+                if not self.woo.active and (self.woo.wal is not None or self.woo.idle()):
                     return
             if BUF_MEASURE: print("{} {}".format(len(self.woo.buf), self.woo.buf.size()))
             if DEBUG: print("SYNC begin, buffer size is", len(self.woo.buf), file=sys.stderr)
@@ -361,13 +809,11 @@ if __name__ == '__main__':
     random.seed(1985)
 
     import backend
-    import os
+    import shutil
+    import tempfile
     # back = []
-    backdir = "dbox"
+    backdir = tempfile.mkdtemp(prefix="dbox")
     key = bytes(random.randrange(256) for _ in range(16))
-    os.makedirs(backdir, exist_ok=True)
-    if os.path.exists(os.path.join(backdir, "0")):
-        os.remove(os.path.join(backdir, "0"))
     back = backend.Backend(key, backdir)
     timing = 2
     K = 20
@@ -589,3 +1035,126 @@ if __name__ == '__main__':
 
         checkit(nextw)
 
+    # check dedup references, holes and repacking against a model of
+    # every file's contents, after every sync round
+    from membackend import MemBackend
+
+    def modelcheck(thew, model):
+        for v, data in model.items():
+            assert thew.get_size(v) == len(data), (v, thew.get_size(v), len(data))
+            assert thew.num_blocks(v) == -(-len(data) // thew.fbsize)
+            for i in range(thew.num_blocks(v)):
+                assert thew.get(v, i) == data[i*thew.fbsize:(i+1)*thew.fbsize]
+
+    def drain(thew, model):
+        while not thew.idle():
+            thew.sync()
+            modelcheck(thew, model)
+
+    for seed, slots, dedup, repack in [(1, 2, True, False), (2, 3, True, True),
+            (3, 4, False, True), (4, 3, True, True)]:
+        random.seed(seed)
+        waldir = tempfile.mkdtemp() if dedup else None
+        back = MemBackend()
+        mw = load_wooram(back, blocksize=2**16, total_blocks=256, drip_rate=8,
+                drip_time=0, wal_dir=waldir, dedup=dedup, repack=repack, slots=slots)
+        fb = mw.fbsize
+        pool = [rblock(fb) for _ in range(6)] # full fragments shared between files
+        model = {}
+
+        def store(v, data):
+            mw.resize(v, len(data))
+            for i in range(-(-len(data) // fb)):
+                mw.set(v, i, data[i*fb:(i+1)*fb])
+            model[v] = data
+
+        for rnd in range(120):
+            op = random.randrange(6)
+            if op == 0 or len(model) < 4:
+                # new file, mostly duplicates of other fragments
+                v = mw.new()
+                store(v, b''.join(random.choice(pool) for _ in range(random.randrange(4)))
+                        + rblock(random.randrange(1, fb)))
+            elif op == 1:
+                # change a fragment, which others may reference
+                v = random.choice(list(model))
+                i = random.randrange(len(model[v]) // fb + 1)
+                if (i+1)*fb <= len(model[v]):
+                    data = random.choice(pool + [rblock(fb)])
+                    mw.set(v, i, data)
+                    model[v] = model[v][:i*fb] + data + model[v][(i+1)*fb:]
+            elif op == 2:
+                # extend, leaving holes
+                v = random.choice(list(model))
+                size = len(model[v]) + random.randrange(1, 4*fb)
+                mw.resize(v, size)
+                model[v] = model[v] + bytes(size - len(model[v]))
+            elif op == 3:
+                # fill part of a hole, or whatever is there
+                v = random.choice(list(model))
+                if len(model[v]) > fb:
+                    i = random.randrange(len(model[v]) // fb)
+                    data = random.choice(pool + [rblock(fb)])
+                    mw.set(v, i, data)
+                    model[v] = model[v][:i*fb] + data + model[v][(i+1)*fb:]
+            elif op == 4:
+                # truncate, perhaps into a hole
+                v = random.choice(list(model))
+                size = random.randrange(len(model[v]) + 1)
+                mw.resize(v, size)
+                model[v] = model[v][:size]
+            else:
+                v = random.choice(list(model))
+                mw.delete(v)
+                del model[v]
+            if rnd % 3 == 0:
+                mw.sync()
+                modelcheck(mw, model)
+
+        if waldir is not None:
+            # what is still buffered comes back from the log
+            mw.finish()
+            mw = load_wooram(back, drip_rate=8, drip_time=0, wal_dir=waldir,
+                    dedup=dedup, repack=repack)
+            modelcheck(mw, model)
+        drain(mw, model)
+        mw.finish()
+        mw = load_wooram(back, drip_rate=8, drip_time=0, repack=repack)
+        modelcheck(mw, model)
+        if waldir is not None:
+            shutil.rmtree(waldir)
+        count += 1
+        print("Passed check", count, "(slots={} dedup={} repack={})".format(slots, dedup, repack))
+
+    # repacking while a vnode's shadow entry has its split fragment in one
+    # evicted block and its current entry has a newer one in another; a
+    # policy holding back the rest of the file keeps the shadow around
+    class HoldBack(Fifo):
+        held = set()
+        def order(self, avail, room, rnd):
+            return [item for item in avail if item[:2] not in self.held]
+    for seed in range(8):
+        random.seed(seed)
+        hold = HoldBack()
+        # every round evicts every block
+        mw = load_wooram(MemBackend(), blocksize=2**16, total_blocks=4, drip_rate=3,
+                drip_time=0, repack=True, policy=hold)
+        fb = mw.fbsize
+        v = mw.new()
+        model = {v: b'0'*fb + b'A'*500}
+        mw.set(v, 0, b'0'*fb)
+        mw.set(v, 1, b'A'*500)
+        mw.sync()
+        model[v] = b'1'*fb + b'B'*900
+        mw.set(v, 0, b'1'*fb)
+        mw.set(v, 1, b'B'*900)
+        hold.held.add((v, 0))
+        for _ in range(12):
+            mw.sync()
+            assert mw.get(v, 1) == b'B'*900
+        hold.held.clear()
+        drain(mw, model)
+    count += 1
+    print("Passed check", count, "(repacking with a shadow entry)")
+
+    shutil.rmtree(backdir)